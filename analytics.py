@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import getopt
+import sys
+
+import numpy as np
+import pandas as pd
+
+from lib.results import RESULT_COLUMNS, parse_completed_date
+
+GROUP_COLUMNS = {
+    'plan': ['plan_key', 'plan_name'],
+    'branch': ['plan_key', 'plan_name', 'branch_key', 'branch_name'],
+}
+
+WINDOWS = {
+    'day': 'D',
+    'week': 'W',
+    'month': 'M',
+}
+
+USAGE = '''Usage: analytics.py [--by=plan|branch] [--window=day|week|month] [--top=N] RESULTS_CSV...
+
+Summarises the build history dumped by results.py, writing one CSV row per plan (or branch) and
+time window, heaviest first by total build time.
+'''
+
+
+def load_results(file_paths):
+    frames = [pd.read_csv(file_path, header=None, names=RESULT_COLUMNS,
+                          usecols=['plan_key', 'plan_name', 'branch_key', 'branch_name', 'completed_date', 'duration', 'successful'],
+                          dtype={'plan_key': str, 'plan_name': str, 'branch_key': str, 'branch_name': str, 'duration': np.float64, 'successful': str},
+                          keep_default_na=False)
+              for file_path in file_paths]
+    results = pd.concat(frames, ignore_index=True)
+    # Parsed one at a time, as only some rows have milliseconds and pandas infers a single format
+    results['completed_date'] = pd.to_datetime(results['completed_date'].map(parse_completed_date))
+    # results.py writes durations as fractions of a day, for spreadsheets
+    results['duration_seconds'] = results['duration'] * 24 * 3600
+    results['successful'] = results['successful'] == 'True'
+    return results.drop(columns=['duration'])
+
+def summarise(results, group_columns, window=None):
+    if window is not None:
+        results = results.assign(window=results['completed_date'].dt.to_period(window))
+        group_columns = group_columns + ['window']
+    grouped = results.groupby(group_columns, sort=False)
+    summary = grouped.agg(builds=('duration_seconds', 'size'),
+                          total_duration_hours=('duration_seconds', 'sum'),
+                          success_ratio=('successful', 'mean'),
+                          first_build=('completed_date', 'min'),
+                          last_build=('completed_date', 'max'))
+    percentiles = grouped['duration_seconds'].quantile([0.5, 0.95]).unstack()
+    summary['p50_duration_seconds'] = percentiles[0.5]
+    summary['p95_duration_seconds'] = percentiles[0.95]
+    summary['total_duration_hours'] /= 3600
+    if window is not None:
+        window_index = summary.index.get_level_values('window')
+        window_days = (window_index.end_time - window_index.start_time).ceil('D').days
+    else:
+        # Without windows, frequency is measured over the span of the whole history
+        history_span = results['completed_date'].max() - results['completed_date'].min()
+        window_days = max(1, history_span.ceil('D').days)
+    summary['builds_per_day'] = summary['builds'] / np.asarray(window_days, dtype=np.float64)
+    summary = summary.drop(columns=['first_build', 'last_build'])
+    return summary.sort_values('total_duration_hours', ascending=False)
+
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], '', ['by=', 'window=', 'top='])
+    opts = dict(optlist)
+    group_by = opts.get('--by', 'plan')
+    window = opts.get('--window')
+    if len(args) == 0 or group_by not in GROUP_COLUMNS or (window is not None and window not in WINDOWS):
+        print(USAGE)
+        exit(1)
+
+    summary = summarise(load_results(args), GROUP_COLUMNS[group_by], WINDOWS.get(window))
+    if '--top' in opts:
+        summary = summary.head(int(opts['--top']))
+    summary.to_csv(sys.stdout, float_format='%.3f')
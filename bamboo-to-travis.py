@@ -1,17 +1,31 @@
+import csv
 import getopt
+import json
 import os
 import re
+import shlex
 import sys
 
 from datetime import datetime
-from github import Github, GithubException, UnknownObjectException, InputGitAuthor
 
 from lib.bamboo import LinkedRepositoriesList, configure_yaml_loader, parse_yml
 from lib.config import get_or_create as get_or_create_config
-from lib.travis import generate_yaml as generate_travis_yaml
+from lib.drift import GraphQLError, fetch_travis_files, has_drifted
+from lib.files import content_hash, file_hash, write_atomic
+from lib.planstore import DirectoryPlanSource, PlanStore
+from lib.profiling import DEFAULT_TOP as DEFAULT_PROFILE_TOP, Profiler
+from lib.results import read_results
+from lib.schedule import SCHEDULE_REPORT_COLUMNS, plan_schedules
+from lib.state import DEFAULT_STATE_FILE, ChangeReport, StateStore
+from lib.travis import JobFragmentCache, converter_version, generate_yaml as generate_travis_yaml, plan_test_shards
+from lib.watch import DEFAULT_DEBOUNCE_SECONDS, watch_directory
 
 LINKED_REPOSITORIES_CSV_FILE = 'repositories.csv'
 CONFIG_FILE = 'config.ini'
+DEFAULT_MAX_SHARDS = 8
+DEFAULT_RESULTS_FILE = 'all_results.csv'
+# Options affecting the generated files, so a change to any of them invalidates every plan
+CONVERSION_OPTIONS = ('--job-cache', '--shard-tests', '--shard-target-minutes', '--results', '--max-shards', '--stagger-minutes')
 
 input_dir = None
 input_file = None
@@ -19,15 +33,22 @@ run_datetime = datetime.now()
 
 
 if len(sys.argv) > 1:
-    optlist, args = getopt.getopt(sys.argv[1:], '', ['base-branch=', 'branch=', 'commit-title=', 'commit-desc=', 'update', 'pr', 'pr-title='])
+    optlist, args = getopt.getopt(sys.argv[1:], '', ['base-branch=', 'branch=', 'commit-title=', 'commit-desc=', 'update', 'pr', 'pr-title=',
+                                                  'output-dir=', 'state-file=', 'force', 'job-cache=',
+                                                  'shard-tests=', 'shard-target-minutes=', 'results=', 'max-shards=', 'watch', 'debounce=', 'drift', 'store=',
+                                                  'profile=', 'profile-top=', 'profile-functions', 'profile-memory',
+                                                  'stagger-minutes=', 'schedule-report='])
     opts = dict(optlist)
 else:
     opts, args = {}, []
 
-if len(args) > 0:
+output_dir = opts.get('--output-dir')
+profiler = Profiler('--profile' in opts or '--profile-top' in opts, '--profile-functions' in opts, '--profile-memory' in opts)
+
+if len(args) > 0 and output_dir is None:
     input_file = args[0]
 else:
-    input_dir = 'plans'
+    input_dir = args[0] if len(args) > 0 else 'plans'
 
 GITHUB_CONFIG_FIELDS = (
     ('user.name', 'Please enter your full name to be used for Git commits: '),
@@ -37,16 +58,93 @@ GITHUB_CONFIG_FIELDS = (
 )
 
 def process_file(file_path):
-    with open(file_path, 'r') as bamboo_yml_file:
+    with profiler.span('parse', file_path), open(file_path, 'r') as bamboo_yml_file:
+        return parse_yml(bamboo_yml_file)
+
+def process_plan_source(plan_source, key):
+    with profiler.span('parse', key), plan_source.open(key) as bamboo_yml_file:
         return parse_yml(bamboo_yml_file)
 
-def process_directory(dir_path):
-    all_plans = []
-    for yaml_file in sorted(os.listdir(dir_path)):
-        bamboo_plan = process_file(os.path.join(dir_path, yaml_file))
+def process_directory_files(plan_source):
+    for key in plan_source.keys():
+        bamboo_plan = process_plan_source(plan_source, key)
         if bamboo_plan is not None:
-            all_plans.append(bamboo_plan)
-    return all_plans
+            yield plan_source.path(key), bamboo_plan
+
+def generate_yml_content(plan, plan_context):
+    return '\n'.join(header_yaml(plan) + generate_travis_yaml(plan, plan_context)) + '\n'
+
+def output_file_name(yaml_file):
+    return '%s.travis.yml' % (os.path.splitext(yaml_file)[0])
+
+def conversion_fingerprint(opts):
+    options = dict((name, opts[name]) for name in CONVERSION_OPTIONS if name in opts)
+    if '--shard-target-minutes' in opts:
+        # Shard counts are derived from the build history, so it counts as an option too
+        options['results_hash'] = file_hash(opts.get('--results', DEFAULT_RESULTS_FILE))
+    return content_hash(json.dumps({'version': converter_version(), 'options': options}, sort_keys=True))
+
+def convert_directory(plan_source, output_dir_path, plan_context, state, force=False, changed_files=None, state_section='convert'):
+    os.makedirs(output_dir_path, exist_ok=True)
+    report = ChangeReport()
+    # Linked repository URLs end up in the generated files, so a change to the mapping, like a change
+    # to the converter, its options or where the files are written, invalidates every plan
+    context_fingerprint = '%s:%s:%s' % (file_hash(LINKED_REPOSITORIES_CSV_FILE), conversion_fingerprint(opts),
+                                        os.path.abspath(output_dir_path))
+    all_yaml_files = plan_source.keys()
+    yaml_files = all_yaml_files if changed_files is None else sorted(set(changed_files) & set(all_yaml_files))
+    for yaml_file in yaml_files:
+        try:
+            fingerprint = content_hash('%s:%s' % (plan_source.hash(yaml_file), context_fingerprint))
+            previous_fingerprint = state.get(state_section, yaml_file)
+            output_path = os.path.join(output_dir_path, output_file_name(yaml_file))
+            if previous_fingerprint == fingerprint and not force and os.path.exists(output_path):
+                report.record(yaml_file, previous_fingerprint, fingerprint)
+                continue
+            plan = process_plan_source(plan_source, yaml_file)
+            if plan is None:
+                # parse_yml has already reported why
+                report.failed.append(yaml_file)
+                continue
+            with profiler.span('convert', yaml_file):
+                yml_content = generate_yml_content(plan, plan_context)
+            with profiler.span('write', yaml_file):
+                write_atomic(output_path, yml_content)
+        except Exception as e:
+            # The file may be half written or use unsupported features, so leave its state for it to be retried
+            print('ERROR: Could not convert %s: %s' % (yaml_file, e), file=sys.stderr)
+            report.failed.append(yaml_file)
+            continue
+        report.record(yaml_file, previous_fingerprint, fingerprint)
+        state.set(state_section, yaml_file, fingerprint)
+    for yaml_file in state.keys(state_section) - set(all_yaml_files):
+        report.removed.append(yaml_file)
+        state.remove(state_section, yaml_file)
+        try:
+            os.remove(os.path.join(output_dir_path, output_file_name(yaml_file)))
+        except FileNotFoundError:
+            pass
+    state.save()
+    return report
+
+def watch_and_convert(dir_path, output_dir_path, plan_context, state, debounce):
+    def on_change(changed_files):
+        report = convert_directory(DirectoryPlanSource(dir_path), output_dir_path, plan_context, state, changed_files=changed_files)
+        print('%s %s' % (datetime.now().strftime('%H:%M:%S'), report.summary_lines()[-1]))
+        for report_line in report.summary_lines()[:-1]:
+            print('  %s' % (report_line))
+        plan_context['job_cache'].save()
+        sys.stdout.flush()
+    print('Watching %s for changes, press Ctrl-C to stop' % (dir_path))
+    sys.stdout.flush()
+    watch_directory(dir_path, on_change, debounce)
+
+def write_schedule_report(plan_source, report_path, plan_context):
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=SCHEDULE_REPORT_COLUMNS)
+        writer.writeheader()
+        for file_path, plan in process_directory_files(plan_source):
+            writer.writerows(plan_schedules(plan, plan_context))
 
 def header_yaml(plan):
     header_lines = ['# Auto-generated .travis.yml file',
@@ -55,41 +153,101 @@ def header_yaml(plan):
     return header_lines
 
 try:
-    config = get_or_create_config(CONFIG_FILE, 'github.com', GITHUB_CONFIG_FIELDS)
-    github_org = config['organization']
-    gh = Github(config['user.token'])
-    linked_repositories = LinkedRepositoriesList(LINKED_REPOSITORIES_CSV_FILE)
-    configure_yaml_loader()
-
-    plan_context = {'linked_repositories': linked_repositories}
-    if input_dir is not None:
-        target_plans = [ plan for plan in process_directory(input_dir) if plan.enabled is True and len(plan.repositories) == 1 ]
+    with profiler.span('load'):
+        linked_repositories = LinkedRepositoriesList(LINKED_REPOSITORIES_CSV_FILE)
+        configure_yaml_loader()
+
+        job_cache = JobFragmentCache(opts.get('--job-cache'))
+        plan_context = {'linked_repositories': linked_repositories, 'job_cache': job_cache,
+                        'test_shards': int(opts.get('--shard-tests', 1)),
+                        'schedule_stagger_minutes': int(opts.get('--stagger-minutes', 0))}
+        if '--shard-target-minutes' in opts:
+            plan_context['plan_test_shards'] = plan_test_shards(read_results(opts.get('--results', DEFAULT_RESULTS_FILE)),
+                                                                float(opts['--shard-target-minutes']),
+                                                                int(opts.get('--max-shards', DEFAULT_MAX_SHARDS)))
+    # Only load PyGithub and the Github configuration for the modes that talk to Github
+    if output_dir is None and (input_dir is not None or len(args) > 1):
+        from github import Github, GithubException, UnknownObjectException, InputGitAuthor
+        config = get_or_create_config(CONFIG_FILE, 'github.com', GITHUB_CONFIG_FIELDS)
+        github_org = config['organization']
+        gh = Github(config['user.token'])
+
+    plan_source = PlanStore(opts['--store']) if '--store' in opts else DirectoryPlanSource(input_dir)
+    if '--schedule-report' in opts and input_dir is not None:
+        write_schedule_report(plan_source, opts['--schedule-report'], plan_context)
+    if output_dir is not None:
+        state = StateStore(opts.get('--state-file', DEFAULT_STATE_FILE))
+        # Plans are keyed by file name in a directory but by plan key in a store, so each has its own state
+        report = convert_directory(plan_source, output_dir, plan_context, state, force='--force' in opts,
+                                   state_section='convert-store' if '--store' in opts else 'convert')
+        for report_line in report.summary_lines():
+            print(report_line)
+        print('%s job fragments reused, %s converted' % (job_cache.hits, job_cache.misses))
+        job_cache.save()
+        if '--watch' in opts and '--store' not in opts:
+            watch_and_convert(input_dir, output_dir, plan_context, state, float(opts.get('--debounce', DEFAULT_DEBOUNCE_SECONDS)))
+        elif report.failed:
+            exit(1)
+    elif input_dir is not None:
+        plan_file_paths = {}
+        target_plans = []
+        for file_path, plan in process_directory_files(plan_source):
+            if plan.enabled is True and len(plan.repositories) == 1:
+                plan_file_paths[plan.full_key()] = file_path
+                target_plans.append(plan)
         plans_by_repo = {}
-        gh_org = gh.get_organization(github_org)
         for plan in target_plans:
-            git_path = plan.get_default_repository_definition().github_path(plan_context)
+            with profiler.span('resolve', plan_file_paths[plan.full_key()]):
+                git_path = plan.get_default_repository_definition().github_path(plan_context)
             if not git_path in plans_by_repo:
                 plans_by_repo[git_path] = []
             plans_by_repo[git_path].append(plan)
-        for git_path, plans in plans_by_repo.items():
-            if len(plans) == 1 and git_path.startswith('%s/' % (github_org)):
-                source_plan = plans[0]
-                gh_repo = gh_org.get_repo(git_path.split('/')[1])
-                if not gh_repo.archived and not gh_repo.fork:
-                    has_travis_file = True
-                    try:
-                        travis_yml = gh_repo.get_contents('.travis.yml')
-                    except UnknownObjectException:
-                        # No .travis.yml found
-                        has_travis_file = False
-                    if not has_travis_file:
-                        print('%s-%s %s' % (source_plan.project['key']['key'], source_plan.key['key'], git_path))
+        if '--drift' in opts:
+            # Print a batch of convert commands (see migrate.py --batch) for repositories whose .travis.yml differs
+            base_branch_name = opts.get('--base-branch', 'master')
+            source_plans = [(git_path, plans[0]) for git_path, plans in plans_by_repo.items() if len(plans) == 1 and git_path.startswith('%s/' % (github_org))]
+            repo_refs = [(github_org, git_path.split('/')[1], base_branch_name) for git_path, source_plan in source_plans]
+            try:
+                with profiler.span('fetch'):
+                    repo_files = fetch_travis_files(config['user.token'], repo_refs)
+            except GraphQLError as e:
+                print('ERROR: Could not fetch .travis.yml files from Github: %s' % (e), file=sys.stderr)
+                exit(1)
+            # The commands must convert plans the same way as the comparison did
+            conversion_opts = ''.join(' %s=%s' % (name, shlex.quote(opts[name])) for name in CONVERSION_OPTIONS if name in opts)
+            for (git_path, source_plan), repo_ref in zip(source_plans, repo_refs):
+                repo_file = repo_files[repo_ref]
+                if repo_file is None or repo_file['archived'] or repo_file['fork']:
+                    continue
+                with profiler.span('convert', plan_file_paths[source_plan.full_key()]):
+                    yml_content = generate_yml_content(source_plan, plan_context)
+                if has_drifted(repo_file['content'], yml_content):
+                    store_opt = ' --store=%s' % (shlex.quote(opts['--store'])) if '--store' in opts else ''
+                    print('convert --update --base-branch=%s%s%s %s %s' % (shlex.quote(base_branch_name), store_opt, conversion_opts,
+                                                                        shlex.quote(plan_file_paths[source_plan.full_key()]), git_path))
+        else:
+            gh_org = gh.get_organization(github_org)
+            for git_path, plans in plans_by_repo.items():
+                if len(plans) == 1 and git_path.startswith('%s/' % (github_org)):
+                    source_plan = plans[0]
+                    with profiler.span('fetch', plan_file_paths[source_plan.full_key()]):
+                        gh_repo = gh_org.get_repo(git_path.split('/')[1])
+                        has_travis_file = True
+                        if not gh_repo.archived and not gh_repo.fork:
+                            try:
+                                travis_yml = gh_repo.get_contents('.travis.yml')
+                            except UnknownObjectException:
+                                # No .travis.yml found
+                                has_travis_file = False
+                        if not has_travis_file:
+                            print('%s-%s %s' % (source_plan.project['key']['key'], source_plan.key['key'], git_path))
     elif input_file is not None:
-        plan = process_file(input_file)
-        output_lines = header_yaml(plan) + generate_travis_yaml(plan, plan_context)
-        yml_content = '\n'.join(output_lines) + '\n'
-        committer = InputGitAuthor(name=config['user.name'], email=config['user.email'])
+        plan = process_plan_source(plan_source, input_file) if '--store' in opts else process_file(input_file)
+        with profiler.span('convert', input_file):
+            yml_content = generate_yml_content(plan, plan_context)
+        job_cache.save()
         if len(args) > 1:
+            committer = InputGitAuthor(name=config['user.name'], email=config['user.email'])
             branch_name = opts.get('--branch', 'dev-travis-migration')
             pr_title = opts.get('--pr-title', 'Add .travis.yml')
             default_commit_message = 'Add .travis.yml' if '--update' not in opts else 'Update .travis.yml'
@@ -104,37 +262,62 @@ try:
             org_name = git_match.group(1)
             repo_name = git_match.group(2)
             file_name = '.travis.yml'
+            base_branch_name = opts.get('--base-branch', 'master')
+            # Avoid a no-op commit (and the CI run it triggers) if the branch, or its base if the branch does not exist yet, is up to date
+            branch_ref, base_branch_ref = (org_name, repo_name, branch_name), (org_name, repo_name, base_branch_name)
             try:
-                repo = gh.get_organization(org_name).get_repo(repo_name)
-                base_branch_name = opts.get('--base-branch', 'master')
-                master_branch = repo.get_branch(base_branch_name)
+                with profiler.span('fetch', input_file):
+                    existing_files = fetch_travis_files(config['user.token'], [branch_ref, base_branch_ref])
+            except GraphQLError as e:
+                # Only needed to skip unchanged files, so push anyway
+                print('WARNING: Could not fetch existing %s: %s' % (file_name, e), file=sys.stderr)
+                existing_files = {branch_ref: None}
+            if existing_files[branch_ref] is not None:
+                existing_content = existing_files[branch_ref]['content'] or existing_files[base_branch_ref]['content']
+                if existing_content is not None and not has_drifted(existing_content, yml_content):
+                    print('File %s in %s is already up to date, nothing to push' % (file_name, git_project_ref))
+                    exit(0)
+            with profiler.span('push', input_file):
                 try:
-                    new_branch = repo.get_git_ref('heads/' + branch_name)
+                    repo = gh.get_organization(org_name).get_repo(repo_name)
+                    master_branch = repo.get_branch(base_branch_name)
+                    try:
+                        new_branch = repo.get_git_ref('heads/' + branch_name)
+                    except UnknownObjectException:
+                        ref_name = 'refs/heads/' + branch_name
+                        new_branch = repo.create_git_ref(ref=ref_name, sha=master_branch.commit.sha)
+                    try:
+                        yml_file = repo.create_file(file_name, message=commit_message, content=yml_content, branch=branch_name, committer=committer, author=committer)
+                        print('Created file %s on branch %s' % (file_name, new_branch.url))
+                    except GithubException as file_exception:
+                        if file_exception.status == 422: # File exists
+                            if '--update' in opts:
+                                file_blob = repo.get_contents(file_name, ref='heads/' + branch_name)
+                                yml_file = repo.update_file(file_name, message=commit_message, content=yml_content, sha=file_blob.sha, branch=branch_name, committer=committer, author=committer)
+                                print('Updated file %s on branch %s' % (file_name, new_branch.url))
+                            else:
+                                print('File %s already exists, must specify --update to update it' % (file_name))
+                                exit(1)
+                    new_branch.edit(yml_file['commit'].sha)
+                    if 'pr' in opts:
+                        pr = repo.create_pull(pr_title, '', base=base_branch_name, head=branch_name, draft=True)
+                        print('Opened pull request %s' % (pr.html_url))
                 except UnknownObjectException:
-                    ref_name = 'refs/heads/' + branch_name
-                    new_branch = repo.create_git_ref(ref=ref_name, sha=master_branch.commit.sha)
-                try:
-                    yml_file = repo.create_file(file_name, message=commit_message, content=yml_content, branch=branch_name, committer=committer, author=committer)
-                    print('Created file %s on branch %s' % (file_name, new_branch.url))
-                except GithubException as file_exception:
-                    if file_exception.status == 422: # File exists
-                        if '--update' in opts:
-                            file_blob = repo.get_contents(file_name, ref='heads/' + branch_name)
-                            yml_file = repo.update_file(file_name, message=commit_message, content=yml_content, sha=file_blob.sha, branch=branch_name, committer=committer, author=committer)
-                            print('Updated file %s on branch %s' % (file_name, new_branch.url))
-                        else:
-                            print('File %s already exists, must specify --update to update it' % (file_name))
-                            exit(1)
-                new_branch.edit(yml_file['commit'].sha)
-                if 'pr' in opts:
-                    pr = repo.create_pull(pr_title, '', base=base_branch_name, head=branch_name, draft=True)
-                    print('Opened pull request %s' % (pr.html_url))
-            except UnknownObjectException:
-                print('Unable to find repository %s, check it exists and your user account has access' % (git_project_ref))
+                    print('Unable to find repository %s, check it exists and your user account has access' % (git_project_ref))
         else:
             print(yml_content)
 
 except KeyboardInterrupt:
     print('KeyboardInterrupt')
+finally:
+    if profiler.enabled:
+        # Written to stderr so as not to mix with generated files or batch commands on stdout
+        profile_top = int(opts.get('--profile-top', DEFAULT_PROFILE_TOP))
+        for profile_line in profiler.stage_totals_lines() + [''] + profiler.top_plans_lines(profile_top):
+            print(profile_line, file=sys.stderr)
+        for profile_line in profiler.function_stats_lines(profile_top) + profiler.memory_stats_lines(profile_top):
+            print(profile_line, file=sys.stderr)
+        if '--profile' in opts:
+            profiler.write_chrome_trace(opts['--profile'])
 
         
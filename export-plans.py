@@ -1,33 +1,133 @@
 #!/usr/bin/python
 
+import asyncio
+import getopt
+import os
 import requests
 import sys
 
 from lib.config import get_or_create as get_or_create_config
-from lib.rest import REST_CONFIG_FIELDS, api_get, api_post
+from lib.files import content_hash, write_if_changed
+from lib.planstore import PlanStore
+from lib.rest import PLAN_EXPANSIONS, REST_CONFIG_FIELDS, api_get, api_post, expand_params
+from lib.state import DEFAULT_STATE_FILE, ChangeReport, StateStore
 
 batch_size = 50
-offset = 0
+
+# Only the key of each plan is needed to export it
+PLAN_FIELDS = ['key']
+
+optlist, args = getopt.getopt(sys.argv[1:], '', ['async', 'concurrency=', 'local', 'output-dir=', 'format=', 'state-file=', 'store='])
+opts = dict(optlist)
 
 config = get_or_create_config('config.ini', 'bamboo', REST_CONFIG_FIELDS)
 auth = (config['username'], config['password'])
 base_path = config['url']
 
-while True:
+def export_plans():
+    offset = 0
+    while True:
+        try:
+            params = dict(expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), **{'max-result': batch_size, 'start-index': offset})
+            r = api_get('/plan', params,
+                        base_path=base_path, auth=auth)
+            response_plans = r.json()['plans']
+            plans = response_plans['plan']
+            for plan in plans:
+                try:
+                    export_resp = api_post('/export/plan/%s' % (plan['key'],), base_path=base_path, auth=auth).json()
+                    for export_resp_file in export_resp:
+                        print('Written %s to %s' % (plan['key'], export_resp_file))
+                except requests.exceptions.HTTPError as e:
+                    print(e)
+            offset += batch_size
+            if offset >= response_plans['size']:
+                break
+        except requests.exceptions.HTTPError as e:
+            print(e)
+
+async def export_plan_async(client, plan_key):
+    import aiohttp
     try:
-        r = api_get('/plan', {'expand': 'plans.plan.branches', 'max-result': batch_size, 'start-index': offset},
-                    base_path=base_path, auth=auth)
-        response_plans = r.json()['plans']
-        plans = response_plans['plan']
-        for plan in plans:
-            try:
-                export_resp = api_post('/export/plan/%s' % (plan['key'],), base_path=base_path, auth=auth).json()
+        return await client.api_post('/export/plan/%s' % (plan_key,))
+    except aiohttp.ClientResponseError as e:
+        print(e)
+        return []
+
+async def export_plans_async(concurrency):
+    from lib.aiorest import AsyncApiClient
+    async with AsyncApiClient(base_path, auth, concurrency) as client:
+        async for response_plans in client.api_get_paged('/plan', expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), 'plans', batch_size):
+            plan_keys = [plan['key'] for plan in response_plans['plan']]
+            export_resps = await asyncio.gather(*[export_plan_async(client, plan_key) for plan_key in plan_keys])
+            for plan_key, export_resp in zip(plan_keys, export_resps):
                 for export_resp_file in export_resp:
-                    print('Written %s to %s' % (plan['key'], export_resp_file))
-            except requests.exceptions.HTTPError as e:
-                print(e)
-        offset += batch_size
-        if offset >= response_plans['size']:
-            break
-    except requests.exceptions.HTTPError as e:
+                    print('Written %s to %s' % (plan_key, export_resp_file))
+
+async def fetch_plan_spec(client, plan_key, spec_format):
+    import aiohttp
+    try:
+        spec_resp = await client.api_get('/plan/%s/specs' % (plan_key,), {'format': spec_format})
+        return spec_resp['spec']['code']
+    except aiohttp.ClientResponseError as e:
         print(e)
+        return None
+
+async def fetch_plan_specs_async(concurrency, output_dir, spec_format, state, store=None):
+    import aiohttp
+    from lib.aiorest import AsyncApiClient
+    if store is None:
+        os.makedirs(output_dir, exist_ok=True)
+    report = ChangeReport()
+    seen_keys = set()
+    try:
+        async with AsyncApiClient(base_path, auth, concurrency) as client:
+            async for response_plans in client.api_get_paged('/plan', expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), 'plans', batch_size, raise_errors=True):
+                plan_keys = [plan['key'] for plan in response_plans['plan']]
+                seen_keys.update(plan_keys)
+                spec_codes = await asyncio.gather(*[fetch_plan_spec(client, plan_key, spec_format) for plan_key in plan_keys])
+                for plan_key, spec_code in zip(plan_keys, spec_codes):
+                    if spec_code is None:
+                        continue
+                    fingerprint = content_hash(spec_code)
+                    report.record(plan_key, state.get('export', plan_key), fingerprint)
+                    if store is not None:
+                        if store.put(plan_key, spec_code):
+                            print('Written %s to %s' % (plan_key, store.file_path))
+                    else:
+                        file_path = os.path.join(output_dir, '%s.yaml' % (plan_key,))
+                        # Writing is cheap compared to the request, so it is done inline on the event loop
+                        if write_if_changed(file_path, spec_code):
+                            print('Written %s to %s' % (plan_key, file_path))
+                    state.set('export', plan_key, fingerprint)
+    except aiohttp.ClientError as e:
+        # Plans not listed yet would otherwise be taken as removed, so leave the state as it was
+        print('Listing plans failed, state not updated: %s' % (e), file=sys.stderr)
+        if store is not None:
+            store.close()
+        exit(1)
+    for plan_key in state.keys('export') - seen_keys:
+        report.removed.append(plan_key)
+        state.remove('export', plan_key)
+        if store is not None:
+            store.remove(plan_key)
+    if store is not None:
+        store.close()
+    state.save()
+    for report_line in report.summary_lines():
+        print(report_line)
+
+try:
+    if '--local' in opts:
+        from lib.aiorest import DEFAULT_CONCURRENCY, run
+        run(fetch_plan_specs_async(int(opts.get('--concurrency', DEFAULT_CONCURRENCY)),
+                                   opts.get('--output-dir', 'plans'), opts.get('--format', 'YAML'),
+                                   StateStore(opts.get('--state-file', DEFAULT_STATE_FILE)),
+                                   PlanStore(opts['--store']) if '--store' in opts else None))
+    elif '--async' in opts:
+        from lib.aiorest import DEFAULT_CONCURRENCY, run
+        run(export_plans_async(int(opts.get('--concurrency', DEFAULT_CONCURRENCY))))
+    else:
+        export_plans()
+except KeyboardInterrupt:
+    print('KeyboardInterrupt')
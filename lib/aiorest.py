@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+import asyncio
+
+import aiohttp
+
+DEFAULT_CONCURRENCY = 50
+
+
+class AsyncApiClient():
+    """Non-blocking counterpart of the helpers in lib.rest.
+
+    Requests are issued over a single pooled aiohttp session and the number of requests in flight
+    is bounded by a semaphore, so many coroutines can share one client safely. Unlike the sync
+    helpers, api_get and api_post return the decoded JSON body rather than the response object.
+    """
+
+    def __init__(self, base_path=None, auth=None, concurrency=DEFAULT_CONCURRENCY):
+        self.base_path = base_path or 'http://localhost:8080/bamboo'
+        self.auth = aiohttp.BasicAuth(*auth) if auth else None
+        self.concurrency = concurrency
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                             auth=self.auth,
+                                             headers={'Accept': 'application/json'},
+                                             raise_for_status=True)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+
+    async def _request(self, method, path, params=None):
+        async with self._semaphore:
+            async with self.session.request(method, '%s/rest/api/latest%s' % (self.base_path, path),
+                                            params=params or {}) as r:
+                return await r.json()
+
+    async def api_get(self, path, params=None):
+        return await self._request('GET', path, params)
+
+    async def api_post(self, path, params=None):
+        return await self._request('POST', path, params)
+
+    async def api_get_paged(self, path, params, json_key, batch_size=100, raise_errors=False):
+        """Yield each page of a paged resource, stopping at the first error unless raise_errors is set."""
+        offset = 0
+        while True:
+            try:
+                api_params = dict(params)
+                api_params['max-result'] = batch_size
+                api_params['start-index'] = offset
+                response_data = (await self.api_get(path, api_params))[json_key]
+                yield response_data
+                offset += batch_size
+                if offset >= response_data['size']:
+                    break
+            except aiohttp.ClientResponseError as e:
+                if raise_errors:
+                    raise
+                print(e)
+                break
+
+
+def run(coro):
+    """Run a coroutine to completion, cancelling it cleanly on Ctrl-C.
+
+    On KeyboardInterrupt the main task is cancelled and given the chance to unwind (closing the
+    client session and any outstanding requests) before the interrupt is re-raised to the caller.
+    """
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        raise
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
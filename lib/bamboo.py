@@ -1,10 +1,11 @@
 import csv
+import posixpath
 import re
+import sys
 import yaml
 
 from datetime import datetime
 from functools import reduce
-from github import Github, UnknownObjectException, InputGitAuthor
 
 
 def _git_url_to_github_path(git_url):
@@ -16,6 +17,24 @@ def _git_url_to_github_path(git_url):
         return None
 
 
+def _key_value(key):
+    if isinstance(key, dict):
+        return key.get('key')
+    return getattr(key, 'key', key)
+
+
+def plan_identifier_key(plan_identifier):
+    if plan_identifier is None:
+        return None
+    if isinstance(plan_identifier, dict):
+        project_key, plan_key = plan_identifier.get('projectKey'), plan_identifier.get('key')
+    else:
+        project_key, plan_key = getattr(plan_identifier, 'projectKey', None), getattr(plan_identifier, 'key', None)
+    if project_key is None or plan_key is None:
+        return None
+    return '%s-%s' % (_key_value(project_key), _key_value(plan_key))
+
+
 class LinkedRepositoriesList():
 
     def __init__(self, file_path):
@@ -91,6 +110,13 @@ class PlanProperties(BambooProperties):
     def get_repository_definition(self):
         for repo in self.repositories:
             yield repo['repositoryDefinition']
+    def full_key(self):
+        return '%s-%s' % (self.project['key']['key'], self.key['key'])
+    def get_tasks(self):
+        for stage in self.stages:
+            for job in stage['jobs']:
+                for task in job['tasks']:
+                    yield task
     def __repr__(self):
         return "%s(project=%r, key=%r, name=%r)" % (
             self.__class__.__name__, self.project['key']['key'], self.key['key'], self.name)
@@ -205,6 +231,9 @@ class BambooTaskProperties(BambooProperties):
         return re.sub('\$\{?bamboo[\._]([\._\w]+)\}?', cls._travis_variable_refs, bamboo_variables)
     def _convert_variable_assignments(cls, bamboo_variables):
         return re.sub('bamboo[\._]([\._\w]+)', cls._travis_variable_assign, bamboo_variables)
+    def _working_path(self, path):
+        working_directory = getattr(self, 'workingSubdirectory', None)
+        return posixpath.join(working_directory, path) if working_directory else path
     def wrap_command(self, cmd, working_directory=None, environment_vars=None):
         env_prefix = environment_vars and ('%s ' % (self._convert_variable_names(environment_vars))) or ''
         cmd_with_prefix = env_prefix + cmd
@@ -224,7 +253,13 @@ class VcsCheckoutTaskProperties(BambooTaskProperties):
         return "%s(description=%r)" % (self.__class__.__name__, self.description)
     def get_jobs(self):
         git_repos = [checkoutItem for checkoutItem in self.checkoutItems if checkoutItem['defaultRepository'] is not True]
-        return {'before_script': ['git clone [repo:%s] %s' % (repo['repository']['name'], repo['path'] or '') for repo in git_repos]}
+        clone_cmds = [('git clone [clone-options:%s] [repo:%s] %s' % (repo['repository']['name'], repo['repository']['name'], repo['path'] or '')).strip() for repo in git_repos]
+        if len(clone_cmds) > 1:
+            # Clone in parallel, failing only once all clones have finished if any of them failed
+            clone_lines = ['CLONE_PIDS=""'] + ['%s & CLONE_PIDS="$CLONE_PIDS $!"' % (clone_cmd,) for clone_cmd in clone_cmds]
+            clone_lines.append('CLONE_STATUS=0; for CLONE_PID in $CLONE_PIDS; do wait $CLONE_PID || CLONE_STATUS=1; done; test $CLONE_STATUS -eq 0')
+            clone_cmds = ['\n'.join(clone_lines)]
+        return {'before_script': clone_cmds}
 
 class ArtifactDownloaderTaskProperties(BambooTaskProperties):
     yaml_tag = 'tag:yaml.org,2002:com.atlassian.bamboo.specs.model.task.ArtifactDownloaderTaskProperties'
@@ -235,9 +270,45 @@ class ArtifactDownloaderTaskProperties(BambooTaskProperties):
         self.sourcePlan = sourcePlan
     def __repr__(self):
         return "%s(description=%r)" % (self.__class__.__name__, self.description)
-    def get_jobs(self):
+    def _s3_download_jobs(self, artifacts):
         return {'before_install': [ 'sudo apt-get -y install awscli'] +
-                ['AWS_ACCESS_KEY_ID= AWS_SECRET_ACCESS_KEY= AWS_DEFAULT_REGION= aws s3 cp "s3://${ARTIFACTS_BUCKET}/${TRAVIS_REPO_SLUG}/${TRAVIS_BUILD_NUMBER}/${TRAVIS_JOB_NUMBER}/%s" "./%s"' % (artifact['artifactName'], artifact['path']) for artifact in self.artifacts]}
+                ['AWS_ACCESS_KEY_ID= AWS_SECRET_ACCESS_KEY= AWS_DEFAULT_REGION= aws s3 cp "s3://${ARTIFACTS_BUCKET}/${TRAVIS_REPO_SLUG}/${TRAVIS_BUILD_NUMBER}/${TRAVIS_JOB_NUMBER}/%s" "./%s"' % (artifact['artifactName'], artifact['path']) for artifact in artifacts]}
+    def get_jobs(self):
+        return self._s3_download_jobs(self.artifacts)
+    def get_artifact_names(self, plan_workspaces):
+        if any(artifact.get('allArtifacts') for artifact in self.artifacts):
+            return set(plan_workspaces.keys())
+        return set(artifact.get('artifactName') for artifact in self.artifacts)
+    def get_workspace_jobs(self, plan_workspaces, plan_key, stage_index):
+        # Shared artifacts of earlier stages in the same plan are handed over via Travis workspaces, others come from S3
+        same_plan = plan_identifier_key(self.sourcePlan) in (None, plan_key)
+        workspace_names = []
+        copy_cmds = []
+        s3_artifacts = []
+        for artifact in self.artifacts:
+            if artifact.get('allArtifacts'):
+                artifact_names = sorted(name for name, workspace in plan_workspaces.items() if workspace['stage'] < stage_index)
+            else:
+                artifact_names = [artifact.get('artifactName')]
+            if not same_plan or not artifact_names or not all(artifact_name in plan_workspaces for artifact_name in artifact_names):
+                s3_artifacts.append(artifact)
+                continue
+            late_names = [artifact_name for artifact_name in artifact_names if plan_workspaces[artifact_name]['stage'] >= stage_index]
+            if late_names:
+                # A workspace can only be used once the stage creating it has finished
+                print('WARNING: Artifacts %s of plan %s are not produced by an earlier stage, downloading them from S3' % (', '.join(late_names), plan_key),
+                      file=sys.stderr)
+                s3_artifacts.append(artifact)
+                continue
+            for artifact_name in artifact_names:
+                workspace = plan_workspaces[artifact_name]
+                workspace_names.append(workspace['name'])
+                if artifact.get('path'):
+                    copy_cmds.append('mkdir -p "%s" && cp -R %s "%s/"' % (artifact['path'], workspace['copy_source'], artifact['path']))
+        travis_jobs = self._s3_download_jobs(s3_artifacts) if s3_artifacts else {}
+        if copy_cmds:
+            travis_jobs['before_script'] = copy_cmds
+        return travis_jobs, workspace_names
 
 class MavenTaskProperties(BambooTaskProperties):
     yaml_tag = 'tag:yaml.org,2002:com.atlassian.bamboo.specs.model.task.MavenTaskProperties'
@@ -262,12 +333,27 @@ class MavenTaskProperties(BambooTaskProperties):
         return ('java', self.jdk)
     def get_jvm(self):
         return 'java'
+    def get_cache(self):
+        # Snapshots of the project's own modules would otherwise be restored into later builds
+        return {'directories': ['$HOME/.m2/repository'],
+                'before_cache': ['find $HOME/.m2/repository -name "*-SNAPSHOT" -type d -prune -exec rm -rf {} +']}
     def get_jobs(self):
         mvn_options = ''
         if self.projectFile:
             mvn_options += ' -F "%s"' % (self.projectFile)
         mvn_cmd = 'mvn %s%s' % (mvn_options, self._convert_variable_names(self.goal.replace('\n', ' ')))
         return {'script': self.wrap_command(mvn_cmd, self.workingSubdirectory, self.environmentVariables)}
+    def get_sharded_jobs(self):
+        # Each shard runs every TEST_SHARDS-th test class, in name order, starting from class TEST_SHARD
+        find_cmd = ('export TEST_SHARD_CLASSES=$(find "%s" -path "*/src/test/java/*" -name "*Test*.java" -exec basename {} .java \\; '
+                    '| sort -u | awk -v shard="$TEST_SHARD" -v shards="$TEST_SHARDS" \'(NR - 1) %% shards == shard\' | paste -sd, -)') % (self.workingSubdirectory or '.')
+        mvn_options = ''
+        if self.projectFile:
+            mvn_options += ' -F "%s"' % (self.projectFile)
+        # A shard without any test classes must not fall back to running the whole suite
+        mvn_options += ' -Dtest="${TEST_SHARD_CLASSES:-NoTestsInShard}" -Dsurefire.failIfNoSpecifiedTests=false -DfailIfNoTests=false'
+        mvn_cmd = 'mvn %s %s' % (mvn_options.strip(), self._convert_variable_names(self.goal.replace('\n', ' ')))
+        return {'script': [find_cmd, self.wrap_command(mvn_cmd, self.workingSubdirectory, self.environmentVariables)]}
 
 class AntTaskProperties(BambooTaskProperties):
     yaml_tag = 'tag:yaml.org,2002:com.atlassian.bamboo.specs.model.task.AntTaskProperties'
@@ -333,6 +419,9 @@ class GruntTaskProperties(BambooTaskProperties):
         return "%s(description=%r)" % (self.__class__.__name__, self.description)
     def get_language(self):
         return ('node_js')
+    def get_cache(self):
+        # Grunt builds install their plugins with npm, so share its cache like Npm tasks do
+        return {'directories': [self._working_path('node_modules'), '$HOME/.npm'], 'before_cache': ['rm -rf $HOME/.npm/_logs']}
     def get_jobs(self):
         grunt_options = []
         if self.gruntFile:
@@ -416,6 +505,9 @@ class InjectVariablesTaskProperties(BambooTaskProperties):
         return {'script': [cat_cmd, source_cmd]}
 
 
+DOCKER_CACHE_DIRECTORY = '$HOME/docker-cache'
+DOCKER_CACHE_TAG = 'travis-cache'
+
 class DockerBuildImageTaskProperties(BambooTaskProperties):
     yaml_tag = 'tag:yaml.org,2002:com.atlassian.bamboo.specs.model.task.docker.DockerBuildImageTaskProperties'
     def __init__(self, description, enabled, environmentVariables, workingSubdirectory, dockerfile, dockerfileContent,
@@ -434,22 +526,44 @@ class DockerBuildImageTaskProperties(BambooTaskProperties):
         return "%s(description=%r)" % (self.__class__.__name__, self.description)
     def get_services(self):
         return ['docker']
+    def _cache_image_name(self):
+        # Builds are usually tagged per build, so the cache uses a fixed tag the next build can find
+        return '%s:%s' % (re.sub(':[^/:]*$', '', self._convert_variable_names(self.imageName)), DOCKER_CACHE_TAG)
+    def _image_cache_file(self):
+        return '%s/%s.tar.gz' % (DOCKER_CACHE_DIRECTORY, re.sub('[^\w\.\-]', '_', self._cache_image_name()))
+    def _uses_layer_cache(self):
+        return bool(self.useCache and self.imageName)
+    def get_cache(self):
+        if not self._uses_layer_cache():
+            return {}
+        cache_image_name = self._cache_image_name()
+        # Save the layers of the image's whole history, not just the final one, so --cache-from can match them
+        save_cmd = 'if docker image inspect "%s" > /dev/null 2>&1; then docker save "%s" $(docker history -q "%s" | grep -v "<missing>") | gzip > "%s"; fi' % (
+            cache_image_name, cache_image_name, cache_image_name, self._image_cache_file())
+        return {'directories': [DOCKER_CACHE_DIRECTORY], 'before_cache': ['mkdir -p %s' % (DOCKER_CACHE_DIRECTORY,), save_cmd]}
     def get_jobs(self):
         docker_opts = []
-        if self.dockerfile:
+        if self.dockerfileContent == 'INLINE':
+            docker_opts.append('--file -')
+        elif self.dockerfile:
             docker_opts.append('--file "%s"' % (self.dockerfile,))
         if self.imageName:
-            docker_opts.append('--tag "%s"' % (self.imageName,))
-        script_cmd = ('docker build %s' % (' '.join(docker_opts),)).strip()
+            docker_opts.append('--tag "%s"' % (self._convert_variable_names(self.imageName),))
+        if self._uses_layer_cache():
+            docker_opts.append('--tag "%s"' % (self._cache_image_name(),))
+            docker_opts.append('--cache-from "%s"' % (self._cache_image_name(),))
+        elif not self.useCache:
+            docker_opts.append('--no-cache')
+        script_cmd = 'docker build %s .' % (' '.join(docker_opts),)
+        cmds = []
+        if self._uses_layer_cache():
+            cmds.append('if [ -f "%s" ]; then gunzip -c "%s" | docker load; fi' % (self._image_cache_file(), self._image_cache_file()))
         if self.dockerfileContent == 'INLINE':
-            pushd_cmd = ('pushd "%s" && ' % (self.workingSubdirectory,)) if self.workingSubdirectory else ''
-            popd_cmd = '&& popd' if self.workingSubdirectory else ''
-            cmd_lines = [('%s%s echo "$(cat <<\'EOF\'' % (pushd_cmd, self._convert_variable_names(self.environmentVariables or ''))).strip()]
-            cmd_lines += self.dockerfile.splitlines()
-            cmd_lines += ['EOF', (') | %s" %s' % (popd_cmd,)).strip()]
-            return [('script', cmd_lines)]
+            build_cmd = self.wrap_command(script_cmd + " <<'EOF'", self.workingSubdirectory, self.environmentVariables)
+            cmds.append('\n'.join([build_cmd] + self.dockerfile.splitlines() + ['EOF']))
         elif self.dockerfileContent == 'FILE':
-            return {'script': self.wrap_command(script_cmd, self.workingSubdirectory, self.environmentVariables)}
+            cmds.append(self.wrap_command(script_cmd, self.workingSubdirectory, self.environmentVariables))
+        return {'script': cmds}
 
 
 class DockerRegistryTaskProperties(BambooTaskProperties):
@@ -584,6 +698,14 @@ class NpmTaskProperties(BambooTaskProperties):
         return "%s(description=%r)" % (self.__class__.__name__, self.description)
     def get_language(self):
         return ('node_js', self.nodeExecutable)
+    def get_cache(self):
+        cache_directories = [self._working_path('node_modules')]
+        before_cache_cmds = []
+        # An isolated cache in Bamboo means the npm cache is not shared between builds
+        if not self.useIsolatedCache:
+            cache_directories.append('$HOME/.npm')
+            before_cache_cmds.append('rm -rf $HOME/.npm/_logs')
+        return {'directories': cache_directories, 'before_cache': before_cache_cmds}
     def get_jobs(self):
         npm_cmd = ('npm %s' % (self.command)).strip()
         return {'script': self.wrap_command(npm_cmd, self.workingSubdirectory, self.environmentVariables)}
@@ -638,6 +760,8 @@ def configure_yaml_loader():
 
     yaml.SafeLoader.add_constructor('tag:yaml.org,2002:com.atlassian.bamboo.specs.api.model.trigger.AnyTriggerProperties', BambooProperties.from_yaml)
 
+    yaml.SafeLoader.add_constructor('tag:yaml.org,2002:com.atlassian.bamboo.specs.api.model.plan.PlanIdentifierProperties', BambooProperties.from_yaml)
+
 def parse_yml(yml_file):
     try:
         build_plan = yaml.safe_load(yml_file).rootEntity
@@ -647,5 +771,5 @@ def parse_yml(yml_file):
             pass
         return build_plan
     except AttributeError as error:
-        print('ERROR: Could not find rootEntity in %s' % yml_file.name)
+        print('ERROR: Could not find rootEntity in %s' % yml_file.name, file=sys.stderr)
         return None
@@ -0,0 +1,99 @@
+import heapq
+
+from collections import deque
+
+WAIT_PERCENTILES = (50, 90, 95, 99)
+
+
+class _BuildState():
+    __slots__ = ('start_time', 'stage_jobs', 'stage_duration', 'stage_index', 'jobs_remaining')
+
+    def __init__(self, start_time, duration, stage_jobs):
+        self.start_time = start_time
+        self.stage_jobs = [job_count for job_count in stage_jobs if job_count > 0] or [1]
+        self.stage_duration = duration / len(self.stage_jobs)
+        self.stage_index = 0
+        self.jobs_remaining = 0
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+def simulate(builds, concurrency):
+    """Replay builds against a limit of concurrency jobs running at once, with jobs started in the order they become ready.
+
+    builds is a list of (start time in seconds, duration in seconds, jobs in each stage) tuples. Stages
+    run one after another, and as Bamboo only records the duration of whole builds, it is shared
+    equally between them. Every job of a stage takes the whole stage duration, which overestimates
+    the load of test shards. Returns a dict of statistics on the time jobs spent waiting for capacity,
+    the utilisation of that capacity and the largest number of jobs waiting.
+    """
+    builds = sorted((_BuildState(*build) for build in builds), key=lambda build: build.start_time)
+    # Jobs of the same stage become ready, and when started together finish, at the same time, so they
+    # are queued and run as groups of [ready time, build, job count] to keep replaying long histories fast
+    ready_groups = deque()
+    ready_count = 0
+    running_groups = []
+    running_count = 0
+    waits = []
+    busy_seconds = 0.0
+    peak_backlog = 0
+    group_sequence = 0
+    build_index = 0
+    build_count = len(builds)
+    now = builds[0].start_time if builds else 0.0
+    heappush, heappop = heapq.heappush, heapq.heappop
+
+    while build_index < build_count or running_groups:
+        # Jobs finishing free up capacity before builds starting at the same time are queued
+        if running_groups and (build_index == build_count or running_groups[0][0] <= builds[build_index].start_time):
+            now, _, build, job_count = heappop(running_groups)
+            running_count -= job_count
+            build.jobs_remaining -= job_count
+            if build.jobs_remaining > 0 or build.stage_index + 1 == len(build.stage_jobs):
+                ready_time = None
+            else:
+                build.stage_index += 1
+                ready_time = now
+        else:
+            build = builds[build_index]
+            build_index += 1
+            now = ready_time = build.start_time
+        if ready_time is not None:
+            build.jobs_remaining = build.stage_jobs[build.stage_index]
+            ready_groups.append([ready_time, build, build.jobs_remaining])
+            ready_count += build.jobs_remaining
+            if ready_count > peak_backlog:
+                peak_backlog = ready_count
+        while ready_groups and running_count < concurrency:
+            group = ready_groups[0]
+            ready_time, build, job_count = group
+            started_count = min(job_count, concurrency - running_count)
+            if started_count == job_count:
+                ready_groups.popleft()
+            else:
+                group[2] -= started_count
+            ready_count -= started_count
+            running_count += started_count
+            waits.extend([now - ready_time] * started_count)
+            busy_seconds += build.stage_duration * started_count
+            group_sequence += 1
+            heappush(running_groups, (now + build.stage_duration, group_sequence, build, started_count))
+
+    waits.sort()
+    span_seconds = now - (builds[0].start_time if builds else 0.0)
+    statistics = {
+        'concurrency': concurrency,
+        'builds': len(builds),
+        'jobs': len(waits),
+        'jobs_waiting_ratio': sum(1 for wait in waits if wait > 0) / len(waits) if waits else 0.0,
+        'mean_wait_seconds': sum(waits) / len(waits) if waits else 0.0,
+    }
+    for percentile in WAIT_PERCENTILES:
+        statistics['p%s_wait_seconds' % (percentile)] = _percentile(waits, percentile)
+    statistics['max_wait_seconds'] = waits[-1] if waits else 0.0
+    statistics['utilisation'] = busy_seconds / (concurrency * span_seconds) if span_seconds > 0 else 0.0
+    statistics['peak_backlog'] = peak_backlog
+    return statistics
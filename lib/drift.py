@@ -0,0 +1,76 @@
+import requests
+
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+DEFAULT_BATCH_SIZE = 50
+TRAVIS_FILE_NAME = '.travis.yml'
+
+GENERATED_HEADER_PREFIX = '# Generated '
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def normalise_travis_yaml(content):
+    """Strip what differs between runs producing the same configuration, i.e. the generation timestamp and whitespace."""
+    if content is None:
+        return None
+    lines = [line.rstrip() for line in content.splitlines() if not line.startswith(GENERATED_HEADER_PREFIX)]
+    return '\n'.join(lines).strip('\n')
+
+def has_drifted(existing_content, generated_content):
+    return normalise_travis_yaml(existing_content) != normalise_travis_yaml(generated_content)
+
+def _repository_query(index):
+    return ('r%s: repository(owner: $owner%s, name: $name%s) { isArchived isFork '
+            'object(expression: $expression%s) { ... on Blob { text } } }') % (index, index, index, index)
+
+def fetch_travis_files(token, repo_refs, batch_size=DEFAULT_BATCH_SIZE, file_name=TRAVIS_FILE_NAME):
+    """Fetch the content of file_name from many repositories using batched GraphQL queries.
+
+    repo_refs is a list of (owner, repository name, branch) tuples. Returns a dict keyed by the same
+    tuples, whose values are dicts with the repository's 'archived' and 'fork' flags and the file
+    'content', or None for repositories which could not be found. The content is None if the file
+    or branch does not exist. Raises GraphQLError if the request fails or Github reports any other
+    error.
+    """
+    repo_files = {}
+    for batch_start in range(0, len(repo_refs), batch_size):
+        batch_refs = repo_refs[batch_start:batch_start + batch_size]
+        variable_defs = []
+        variables = {}
+        for index, (owner, name, branch) in enumerate(batch_refs):
+            variable_defs.append('$owner%s: String!, $name%s: String!, $expression%s: String!' % (index, index, index))
+            variables.update({'owner%s' % index: owner, 'name%s' % index: name, 'expression%s' % index: '%s:%s' % (branch, file_name)})
+        query = 'query(%s) { %s }' % (', '.join(variable_defs), ' '.join(_repository_query(index) for index in range(len(batch_refs))))
+        try:
+            r = requests.post(GITHUB_GRAPHQL_URL,
+                              json={'query': query, 'variables': variables},
+                              headers={'Authorization': 'bearer %s' % (token)})
+            r.raise_for_status()
+            response_json = r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise GraphQLError(e)
+        # Missing repositories are reported as errors alongside the data for the others, anything else
+        # (e.g. an invalid token or rate limiting) would otherwise make every repository look missing
+        aliases = set('r%s' % index for index in range(len(batch_refs)))
+        missing_aliases = set()
+        for error in response_json.get('errors') or []:
+            error_path = error.get('path') or []
+            if error.get('type') == 'NOT_FOUND' and len(error_path) == 1 and error_path[0] in aliases:
+                missing_aliases.add(error_path[0])
+            else:
+                raise GraphQLError(error.get('message', error))
+        response_data = response_json.get('data')
+        if response_data is None:
+            raise GraphQLError('No data in response')
+        for index, repo_ref in enumerate(batch_refs):
+            repository = response_data.get('r%s' % index)
+            if repository is None:
+                if 'r%s' % index not in missing_aliases:
+                    raise GraphQLError('No data for repository %s/%s' % (repo_ref[0], repo_ref[1]))
+                repo_files[repo_ref] = None
+            else:
+                repo_files[repo_ref] = {'archived': repository['isArchived'], 'fork': repository['isFork'],
+                                        'content': (repository['object'] or {}).get('text')}
+    return repo_files
@@ -0,0 +1,40 @@
+import hashlib
+import os
+import tempfile
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def file_hash(file_path):
+    try:
+        with open(file_path, 'rb') as existing_file:
+            return content_hash(existing_file.read())
+    except FileNotFoundError:
+        return None
+
+def write_atomic(file_path, content):
+    # Write to a temporary file in the same directory so the final rename cannot cross filesystems
+    dir_path = os.path.dirname(file_path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.%s.' % os.path.basename(file_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as temp_file:
+            temp_file.write(content)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def write_if_changed(file_path, content):
+    """Atomically write content to file_path unless the file already holds identical content.
+
+    Returns True if the file was written, False if it was left untouched.
+    """
+    if file_hash(file_path) == content_hash(content):
+        return False
+    write_atomic(file_path, content)
+    return True
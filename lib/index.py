@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import sys
+
+from lib.bamboo import ArtifactDownloaderTaskProperties, parse_yml, plan_identifier_key
+from lib.files import content_hash
+from lib.planstore import DirectoryPlanSource
+
+DEFAULT_INDEX_FILE = 'plans.index.db'
+
+# Increased whenever the tables change, so indexes written by an earlier version are rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS index_settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS plan_files (
+    file_name TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    plan_key TEXT
+);
+CREATE TABLE IF NOT EXISTS plans (
+    file_name TEXT PRIMARY KEY,
+    plan_key TEXT NOT NULL,
+    name TEXT,
+    enabled INTEGER
+);
+CREATE INDEX IF NOT EXISTS plans_key ON plans (plan_key);
+CREATE TABLE IF NOT EXISTS plan_repositories (
+    file_name TEXT NOT NULL,
+    plan_key TEXT NOT NULL,
+    repository_name TEXT,
+    repository_url TEXT
+);
+CREATE INDEX IF NOT EXISTS plan_repositories_name ON plan_repositories (repository_name);
+CREATE INDEX IF NOT EXISTS plan_repositories_url ON plan_repositories (repository_url);
+CREATE TABLE IF NOT EXISTS artifact_dependencies (
+    file_name TEXT NOT NULL,
+    plan_key TEXT NOT NULL,
+    source_plan_key TEXT NOT NULL,
+    artifact_name TEXT
+);
+CREATE INDEX IF NOT EXISTS artifact_dependencies_source ON artifact_dependencies (source_plan_key);
+CREATE TABLE IF NOT EXISTS plan_triggers (
+    file_name TEXT NOT NULL,
+    plan_key TEXT NOT NULL,
+    trigger_type TEXT NOT NULL,
+    enabled INTEGER,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS plan_triggers_type ON plan_triggers (trigger_type);
+'''
+
+PLAN_TABLES = ('plans', 'plan_repositories', 'artifact_dependencies', 'plan_triggers')
+ALL_TABLES = ('index_settings', 'plan_files') + PLAN_TABLES
+
+
+def _trigger_detail(trigger):
+    for attr_name in ('cronExpression', 'triggerIPAddresses'):
+        if getattr(trigger, attr_name, None):
+            return str(getattr(trigger, attr_name))
+    return None
+
+
+class PlanIndex():
+    """Relationships between plans extracted from a directory of Bamboo YAML files, kept in SQLite.
+
+    update() only re-parses files whose size, modification time and content hash differ from what
+    was last indexed, and drops plans whose files have been removed. Rows are kept per file, so
+    several files defining the same plan do not overwrite each other. Everything is re-indexed when
+    the context fingerprint, covering inputs such as the linked repositories list, changes.
+    """
+
+    def __init__(self, file_path=DEFAULT_INDEX_FILE):
+        self.connection = sqlite3.connect(file_path)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            with self.connection:
+                for table_name in ALL_TABLES:
+                    self.connection.execute('DROP TABLE IF EXISTS %s' % (table_name,))
+                self.connection.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, dir_path, context=None, context_fingerprint=''):
+        yaml_files = DirectoryPlanSource(dir_path).keys()
+        updated_files = []
+        with self.connection:
+            row = self.connection.execute("SELECT value FROM index_settings WHERE name = 'context_fingerprint'").fetchone()
+            if row is None or row[0] != context_fingerprint:
+                # Repository URLs and the like depend on the context, so none of the indexed rows can be kept
+                for table_name in ('plan_files',) + PLAN_TABLES:
+                    self.connection.execute('DELETE FROM %s' % (table_name,))
+                self.connection.execute("INSERT OR REPLACE INTO index_settings VALUES ('context_fingerprint', ?)", (context_fingerprint,))
+            indexed_files = dict((row[0], row[1:]) for row in self.connection.execute('SELECT file_name, mtime, size, hash FROM plan_files'))
+            for yaml_file in yaml_files:
+                try:
+                    self._update_file(dir_path, yaml_file, indexed_files.get(yaml_file), context, updated_files)
+                except Exception as e:
+                    # Leave the file out of the index so it is parsed again on the next update
+                    print('ERROR: Could not index %s: %s' % (yaml_file, e), file=sys.stderr)
+                    self._remove_file(yaml_file)
+                    self.connection.execute('DELETE FROM plan_files WHERE file_name = ?', (yaml_file,))
+            removed_files = sorted(set(indexed_files.keys()) - set(yaml_files))
+            for yaml_file in removed_files:
+                self._remove_file(yaml_file)
+                self.connection.execute('DELETE FROM plan_files WHERE file_name = ?', (yaml_file,))
+        return updated_files, removed_files
+
+    def _update_file(self, dir_path, yaml_file, indexed_file, context, updated_files):
+        file_path = os.path.join(dir_path, yaml_file)
+        file_stat = os.stat(file_path)
+        if indexed_file is not None and indexed_file[:2] == (file_stat.st_mtime, file_stat.st_size):
+            return
+        with open(file_path, 'rb') as yaml_file_bytes:
+            file_content = yaml_file_bytes.read()
+        fingerprint = content_hash(file_content)
+        if indexed_file is None or indexed_file[2] != fingerprint:
+            self._remove_file(yaml_file)
+            with open(file_path, 'r') as bamboo_yml_file:
+                plan = parse_yml(bamboo_yml_file)
+            plan_key = self._add_plan(yaml_file, plan, context) if plan is not None else None
+            updated_files.append(yaml_file)
+        else:
+            plan_key = self.connection.execute('SELECT plan_key FROM plan_files WHERE file_name = ?', (yaml_file,)).fetchone()[0]
+        self.connection.execute('INSERT OR REPLACE INTO plan_files VALUES (?, ?, ?, ?, ?)',
+                                (yaml_file, file_stat.st_mtime, file_stat.st_size, fingerprint, plan_key))
+
+    def _remove_file(self, yaml_file):
+        for table_name in PLAN_TABLES:
+            self.connection.execute('DELETE FROM %s WHERE file_name = ?' % (table_name,), (yaml_file,))
+
+    def _add_plan(self, yaml_file, plan, context=None):
+        plan_key = plan.full_key()
+        self.connection.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?)', (yaml_file, plan_key, plan.name, plan.enabled))
+        for repository in plan.get_repository_definition():
+            repository_name = getattr(repository, 'parent', None) or getattr(repository, 'name', None)
+            self.connection.execute('INSERT INTO plan_repositories VALUES (?, ?, ?, ?)', (yaml_file, plan_key, repository_name, repository.git_url(context)))
+        for task in plan.get_tasks():
+            if isinstance(task, ArtifactDownloaderTaskProperties):
+                # Downloads without an explicit source plan come from the plan itself
+                source_plan_key = plan_identifier_key(task.sourcePlan) or plan_key
+                for artifact in task.artifacts or []:
+                    self.connection.execute('INSERT INTO artifact_dependencies VALUES (?, ?, ?, ?)', (yaml_file, plan_key, source_plan_key, artifact.get('artifactName')))
+        for trigger in plan.triggers or []:
+            self.connection.execute('INSERT INTO plan_triggers VALUES (?, ?, ?, ?, ?)',
+                                    (yaml_file, plan_key, type(trigger).__name__, getattr(trigger, 'enabled', None), _trigger_detail(trigger)))
+        return plan_key
+
+    def plans_using_repository(self, repository):
+        return self.connection.execute('SELECT DISTINCT plan_key, repository_name, repository_url FROM plan_repositories WHERE repository_name = ? OR repository_url = ? ORDER BY plan_key',
+                                       (repository, repository)).fetchall()
+
+    def artifact_consumers(self, source_plan_key):
+        return self.connection.execute('SELECT DISTINCT plan_key, artifact_name FROM artifact_dependencies WHERE source_plan_key = ? ORDER BY plan_key, artifact_name',
+                                       (source_plan_key,)).fetchall()
+
+    def artifact_sources(self, plan_key):
+        return self.connection.execute('SELECT DISTINCT source_plan_key, artifact_name FROM artifact_dependencies WHERE plan_key = ? ORDER BY source_plan_key, artifact_name',
+                                       (plan_key,)).fetchall()
+
+    def plans_with_trigger(self, trigger_type):
+        return self.connection.execute('SELECT DISTINCT plan_key, enabled, detail FROM plan_triggers WHERE trigger_type = ? ORDER BY plan_key',
+                                       (trigger_type,)).fetchall()
@@ -0,0 +1,103 @@
+import io
+import os
+import sqlite3
+
+from lib.files import content_hash, file_hash, write_if_changed
+from lib.watch import is_plan_file
+
+DEFAULT_STORE_FILE = 'plans.db'
+PLAN_FILE_EXTENSION = '.yaml'
+
+
+class DirectoryPlanSource():
+    """Plans kept as individual YAML files in a directory, keyed by file name."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+    def keys(self):
+        return sorted(file_name for file_name in os.listdir(self.dir_path)
+                      if is_plan_file(file_name) and os.path.isfile(os.path.join(self.dir_path, file_name)))
+
+    def hash(self, key):
+        return file_hash(os.path.join(self.dir_path, key))
+
+    def open(self, key):
+        return open(os.path.join(self.dir_path, key), 'r')
+
+    def path(self, key):
+        return os.path.join(self.dir_path, key)
+
+
+class PlanStore():
+    """Plans packed into a single SQLite file, keyed by plan key, with the content hash of each entry.
+
+    Listing keys and comparing hashes only reads the index, so unchanged plans cost no file I/O.
+    """
+
+    def __init__(self, file_path=DEFAULT_STORE_FILE):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS plans (plan_key TEXT PRIMARY KEY, hash TEXT NOT NULL, content TEXT NOT NULL)')
+
+    def keys(self):
+        return [row[0] for row in self.connection.execute('SELECT plan_key FROM plans ORDER BY plan_key')]
+
+    def hash(self, key):
+        row = self.connection.execute('SELECT hash FROM plans WHERE plan_key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get(self, key):
+        row = self.connection.execute('SELECT content FROM plans WHERE plan_key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def open(self, key):
+        content = self.get(key)
+        if content is None:
+            raise FileNotFoundError('Plan %s not found in %s' % (key, self.file_path))
+        plan_file = io.StringIO(content)
+        plan_file.name = key
+        return plan_file
+
+    def path(self, key):
+        return key
+
+    def items(self):
+        return self.connection.execute('SELECT plan_key, content FROM plans ORDER BY plan_key')
+
+    def put(self, key, content):
+        """Store the content of a plan, returning False if it was already stored unchanged.
+
+        Changes are written in a single transaction when commit() or close() is called.
+        """
+        fingerprint = content_hash(content)
+        if self.hash(key) == fingerprint:
+            return False
+        self.connection.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?)', (key, fingerprint, content))
+        return True
+
+    def remove(self, key):
+        self.connection.execute('DELETE FROM plans WHERE plan_key = ?', (key,))
+
+    def commit(self):
+        self.connection.commit()
+
+    def import_directory(self, dir_path):
+        source = DirectoryPlanSource(dir_path)
+        imported_keys = []
+        for file_name in source.keys():
+            with source.open(file_name) as plan_file:
+                plan_key = file_name[:-len(PLAN_FILE_EXTENSION)] if file_name.endswith(PLAN_FILE_EXTENSION) else file_name
+                if self.put(plan_key, plan_file.read()):
+                    imported_keys.append(plan_key)
+        self.commit()
+        return imported_keys
+
+    def export_directory(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        return [plan_key for plan_key, content in self.items()
+                if write_if_changed(os.path.join(dir_path, plan_key + PLAN_FILE_EXTENSION), content)]
+
+    def close(self):
+        self.commit()
+        self.connection.close()
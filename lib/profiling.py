@@ -0,0 +1,122 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+DEFAULT_TOP = 10
+
+
+class Profiler():
+    """Records timing spans for the stages of processing each plan, e.g. parsing, converting and pushing.
+
+    Spans are only recorded when enabled, so call sites can use span() unconditionally. With functions,
+    each outermost span is also run under a cProfile profiler kept per stage, and with memory the
+    memory allocated by each span is tracked using tracemalloc.
+    """
+
+    def __init__(self, enabled=False, functions=False, memory=False):
+        self.enabled = enabled or functions or memory
+        self.spans = []
+        self.depth = 0
+        self.function_profiles = {} if functions else None
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage, plan_key=None):
+        if not self.enabled:
+            yield
+            return
+        # Only the outermost span is profiled, as cProfile does not support being enabled twice
+        function_profile = None
+        if self.function_profiles is not None and self.depth == 0:
+            function_profile = self.function_profiles.setdefault(stage, cProfile.Profile())
+        memory_before = tracemalloc.get_traced_memory()[0] if self.memory else None
+        self.depth += 1
+        if function_profile is not None:
+            function_profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if function_profile is not None:
+                function_profile.disable()
+            self.depth -= 1
+            span = {'stage': stage, 'plan': plan_key, 'start': start - self.start_time, 'duration': end - start}
+            if memory_before is not None:
+                span['memory'] = tracemalloc.get_traced_memory()[0] - memory_before
+            self.spans.append(span)
+
+    def plan_totals(self):
+        """Return a dict of plan key to a dict of the total seconds spent in each stage for that plan."""
+        plan_totals = {}
+        for span in self.spans:
+            if span['plan'] is not None:
+                stage_totals = plan_totals.setdefault(span['plan'], {})
+                stage_totals[span['stage']] = stage_totals.get(span['stage'], 0) + span['duration']
+        return plan_totals
+
+    def top_plans_lines(self, top=DEFAULT_TOP):
+        plan_totals = self.plan_totals()
+        stages = []
+        for span in self.spans:
+            if span['plan'] is not None and span['stage'] not in stages:
+                stages.append(span['stage'])
+        slowest = sorted(plan_totals.items(), key=lambda item: sum(item[1].values()), reverse=True)[:top]
+        key_width = max([len('plan')] + [len(plan_key) for plan_key, stage_totals in slowest])
+        row_format = '%-' + str(key_width) + 's' + ' %10s' * (len(stages) + 1)
+        lines = [row_format % tuple(['plan', 'total'] + stages)]
+        for plan_key, stage_totals in slowest:
+            lines.append(row_format % tuple([plan_key, '%.3f' % (sum(stage_totals.values()))] +
+                                            ['%.3f' % (stage_totals.get(stage, 0)) for stage in stages]))
+        return lines
+
+    def stage_totals_lines(self):
+        stage_totals = {}
+        for span in self.spans:
+            count, duration = stage_totals.get(span['stage'], (0, 0))
+            stage_totals[span['stage']] = (count + 1, duration + span['duration'])
+        return ['%s: %s spans, %.3fs' % (stage, count, duration) for stage, (count, duration) in stage_totals.items()]
+
+    def function_stats_lines(self, top=DEFAULT_TOP):
+        if self.function_profiles is None:
+            return []
+        lines = []
+        for stage, function_profile in self.function_profiles.items():
+            lines.append('Functions in stage %s:' % (stage))
+            # pstats cannot be created from a profile without any samples
+            if not function_profile.getstats():
+                lines.append('  no samples')
+                continue
+            stats_output = io.StringIO()
+            pstats.Stats(function_profile, stream=stats_output).sort_stats('cumulative').print_stats(top)
+            lines += stats_output.getvalue().strip('\n').splitlines()
+        if not lines:
+            lines.append('No functions profiled, as no stage was run')
+        return lines
+
+    def memory_stats_lines(self, top=DEFAULT_TOP):
+        if not self.memory:
+            return []
+        return [str(statistic) for statistic in tracemalloc.take_snapshot().statistics('lineno')[:top]]
+
+    def write_chrome_trace(self, file_path):
+        """Write the spans in Chrome trace event format, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        trace_events = []
+        for span in self.spans:
+            event = {'name': span['stage'] if span['plan'] is None else '%s %s' % (span['stage'], span['plan']),
+                     'cat': span['stage'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                     'ts': round(span['start'] * 1000000), 'dur': round(span['duration'] * 1000000),
+                     'args': {key: span[key] for key in ('plan', 'memory') if span.get(key) is not None}}
+            trace_events.append(event)
+        with open(file_path, 'w') as trace_file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
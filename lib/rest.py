@@ -8,13 +8,14 @@ REST_CONFIG_FIELDS = (
     ('password', 'Please enter your Bamboo password: '),
 )
 
-def api_get(path, params=None, base_path=None, auth=None):
+def api_get(path, params=None, base_path=None, auth=None, headers=None, timeout=None):
     params = params or {}
     base_path = base_path or 'http://localhost:8080/bamboo'
     r = requests.get('%s/rest/api/latest%s' % (base_path, path),
                      params=params,
                      auth=auth,
-                     headers={'Accept': 'application/json'})
+                     headers=dict({'Accept': 'application/json'}, **(headers or {})),
+                     timeout=timeout)
     r.raise_for_status()
     return r
 
@@ -45,3 +46,38 @@ def api_get_paged(path, params, json_key, batch_size=100, base_path=None, auth=N
             print(e)
             break
 
+
+# Parts of each entity which Bamboo only includes in list responses when expanded, keyed by the
+# field path prefix needing them. The empty prefix is the entity itself, needed by any field.
+PLAN_EXPANSIONS = {
+    '': 'plans.plan',
+    'actions': 'plans.plan.actions',
+    'branches': 'plans.plan.branches',
+    'stages': 'plans.plan.stages',
+    'variableContext': 'plans.plan.variableContext',
+}
+RESULT_EXPANSIONS = {
+    '': 'results.result',
+    'artifacts': 'results.result.artifacts',
+    'changes': 'results.result.changes',
+    'comments': 'results.result.comments',
+    'jiraIssues': 'results.result.jiraIssues',
+    'labels': 'results.result.labels',
+    'plan': 'results.result.plan',
+    'stages': 'results.result.stages',
+    'variables': 'results.result.variables',
+}
+
+def expand_param(fields, expansions):
+    """Return the minimal expand parameter for a list response to include the given entity fields.
+
+    fields are the dotted paths of the values read from each entity, e.g. 'branches.key'.
+    """
+    expands = set(expand for field in fields for prefix, expand in expansions.items()
+                  if prefix == '' or field == prefix or field.startswith(prefix + '.'))
+    # Expanding a nested element also expands its parents, so these can be left out
+    return ','.join(sorted(expand for expand in expands if not any(other.startswith(expand + '.') for other in expands)))
+
+def expand_params(fields, expansions):
+    expand = expand_param(fields, expansions)
+    return {'expand': expand} if expand else {}
@@ -0,0 +1,25 @@
+import csv
+
+from datetime import datetime
+
+# Columns of the CSV rows written by results.py and branches.py
+RESULT_COLUMNS = ('plan_key', 'plan_name', 'branch_key', 'branch_name', 'enabled', 'build_result_key',
+                  'completed_date', 'duration', 'life_cycle_state', 'successful', 'build_reason')
+
+COMPLETED_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def sheets_time_to_seconds(sheets_time):
+    return float(sheets_time) * 24 * 3600
+
+def parse_completed_date(completed_date):
+    try:
+        return datetime.strptime(completed_date, COMPLETED_DATE_FORMAT)
+    except ValueError:
+        return datetime.strptime(completed_date, COMPLETED_DATE_FORMAT[:-3])
+
+def read_results(file_path):
+    with open(file_path, newline='') as csv_file:
+        for csv_row in csv.reader(csv_file):
+            if len(csv_row) == len(RESULT_COLUMNS):
+                yield dict(zip(RESULT_COLUMNS, csv_row))
@@ -0,0 +1,95 @@
+import json
+
+from lib.rest import api_get
+
+DEFAULT_INTERVAL_SECONDS = 10
+# A full sample is written this often, so a file can be decoded from any keyframe onwards
+KEYFRAME_INTERVAL_SECONDS = 3600
+
+SET_FIELDS = ('queued', 'busy')
+COUNT_FIELDS = ('online', 'enabled')
+
+
+class ConditionalFetcher():
+    """Fetches JSON resources from Bamboo, sending the ETag of the last response so unchanged resources are not resent.
+
+    Only the last response of each path is kept. Requests taking longer than timeout seconds raise
+    requests.exceptions.Timeout.
+    """
+
+    def __init__(self, base_path=None, auth=None, timeout=None):
+        self.base_path = base_path
+        self.auth = auth
+        self.timeout = timeout
+        self.responses = {}
+
+    def get(self, path, params=None):
+        etag, response_json = self.responses.get(path, (None, None))
+        r = api_get(path, params, base_path=self.base_path, auth=self.auth,
+                    headers={'If-None-Match': etag} if etag is not None else None, timeout=self.timeout)
+        if r.status_code == 304:
+            return response_json
+        response_json = r.json()
+        if 'ETag' in r.headers:
+            self.responses[path] = (r.headers['ETag'], response_json)
+        return response_json
+
+
+def queue_state(queue_json, agents_json):
+    """Reduce the build queue and agent list responses to the keys of queued builds, ids of busy agents and agent counts."""
+    return {
+        'queued': set(queued_build['buildResultKey'] for queued_build in queue_json['queuedBuilds'].get('queuedBuild', [])),
+        'busy': set(str(agent['id']) for agent in agents_json if agent.get('busy')),
+        'online': sum(1 for agent in agents_json if agent.get('active')),
+        'enabled': sum(1 for agent in agents_json if agent.get('enabled')),
+    }
+
+def fetch_queue_state(fetcher):
+    return queue_state(fetcher.get('/queue', {'expand': 'queuedBuilds'}), fetcher.get('/agent'))
+
+
+class DeltaEncoder():
+    """Encodes each sample as the changes since the previous one, with a full keyframe every keyframe_interval seconds."""
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL_SECONDS):
+        self.keyframe_interval = keyframe_interval
+        self.last_state = None
+        self.last_keyframe_time = None
+
+    def encode(self, sample_time, state):
+        record = {'t': round(sample_time, 3)}
+        if self.last_state is None or sample_time - self.last_keyframe_time >= self.keyframe_interval:
+            record['key'] = 1
+            record.update({field: sorted(state[field]) for field in SET_FIELDS})
+            record.update({field: state[field] for field in COUNT_FIELDS})
+            self.last_keyframe_time = sample_time
+        else:
+            for field in SET_FIELDS:
+                added, removed = state[field] - self.last_state[field], self.last_state[field] - state[field]
+                if added:
+                    record['+' + field] = sorted(added)
+                if removed:
+                    record['-' + field] = sorted(removed)
+            record.update({field: state[field] for field in COUNT_FIELDS if state[field] != self.last_state[field]})
+        self.last_state = state
+        return record
+
+def read_samples(file_path):
+    """Yield (sample time, state) for each sample in a file written using DeltaEncoder, from its first keyframe."""
+    state = None
+    with open(file_path, 'r') as samples_file:
+        for line in samples_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the sampler was killed while writing it
+                continue
+            if record.get('key'):
+                state = {field: set(record[field]) for field in SET_FIELDS}
+                state.update({field: record[field] for field in COUNT_FIELDS})
+            elif state is not None:
+                for field in SET_FIELDS:
+                    state[field] = (state[field] | set(record.get('+' + field, []))) - set(record.get('-' + field, []))
+                state.update({field: record[field] for field in COUNT_FIELDS if field in record})
+            if state is not None:
+                yield record['t'], state
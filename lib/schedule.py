@@ -0,0 +1,116 @@
+import hashlib
+import re
+import sys
+
+QUARTZ_FIELDS = ('seconds', 'minutes', 'hours', 'day_of_month', 'month', 'day_of_week', 'year')
+MINUTES_PER_DAY = 24 * 60
+
+SCHEDULE_REPORT_COLUMNS = ('plan_key', 'trigger_name', 'enabled', 'bamboo_cron', 'staggered_cron', 'travis_interval', 'start_time')
+
+
+def parse_cron(cron_expression):
+    """Split a Quartz cron expression, as used by Bamboo, into a dict of its fields."""
+    values = cron_expression.split()
+    if not 6 <= len(values) <= 7:
+        raise ValueError('Invalid cron expression %s' % (cron_expression))
+    return dict(zip(QUARTZ_FIELDS, values + ['*'] * (len(QUARTZ_FIELDS) - len(values))))
+
+def _is_single(value):
+    return re.match(r'^\d+$', value) is not None
+
+def _is_any(value):
+    return value in ('*', '?')
+
+def travis_cron_interval(cron_expression):
+    """Return the Travis cron interval (daily, weekly or monthly) closest to a Bamboo cron expression.
+
+    Travis cannot run more often than daily, so schedules running several times a day, on several
+    days of the week or on several days of the month (lists, ranges or steps) are converted to daily
+    builds. Schedules on one day of the month, or on e.g. the third or last Friday of the month, are
+    converted to monthly builds.
+    """
+    fields = parse_cron(cron_expression)
+    day_of_month, day_of_week = fields['day_of_month'], fields['day_of_week']
+    if not _is_any(day_of_month) and _is_any(day_of_week):
+        # A single day, the last (L, L-3) or nearest weekday (15W, LW) of the month
+        return 'monthly' if re.match(r'^(\d+W?|L(W|-\d+)?)$', day_of_month) else 'daily'
+    if re.match(r'^\w+(#\d|L)$', day_of_week):
+        return 'monthly'
+    if re.match(r'^\w+$', day_of_week) and not _is_any(day_of_week):
+        return 'weekly'
+    return 'daily'
+
+def cron_start_minute(cron_expression):
+    """Return the minute of the day a cron expression runs at, or None if it does not run at one fixed time."""
+    fields = parse_cron(cron_expression)
+    if _is_single(fields['hours']) and _is_single(fields['minutes']):
+        return int(fields['hours']) * 60 + int(fields['minutes'])
+    return None
+
+def stagger_offset(plan_key, window_minutes):
+    """Return a number of minutes in [0, window_minutes) to delay a plan's scheduled builds by.
+
+    The offset only depends on the plan key, so plans sharing a schedule are spread across the
+    window and each plan keeps the same start time however many other plans there are.
+    """
+    if window_minutes <= 0:
+        return 0
+    return int(hashlib.sha1(plan_key.encode('utf-8')).hexdigest(), 16) % window_minutes
+
+def staggered_cron(cron_expression, plan_key, window_minutes):
+    start_minute = cron_start_minute(cron_expression)
+    if start_minute is None or window_minutes <= 0:
+        return cron_expression
+    # Stay on the same day, so weekly and monthly schedules keep their day, and never move a build earlier
+    # than it was, as other builds may depend on it having run. Late schedules are spread over what is
+    # left of the day instead.
+    staggered_minute = start_minute + stagger_offset(plan_key, min(window_minutes, MINUTES_PER_DAY - start_minute))
+    fields = parse_cron(cron_expression)
+    fields['hours'], fields['minutes'] = str(staggered_minute // 60), str(staggered_minute % 60)
+    return ' '.join(fields[field] for field in QUARTZ_FIELDS[:len(cron_expression.split())])
+
+def plan_schedules(plan, context=None):
+    """Return a dict per scheduled trigger of the plan, with SCHEDULE_REPORT_COLUMNS as keys."""
+    window_minutes = (context or {}).get('schedule_stagger_minutes', 0)
+    plan_key = plan.full_key()
+    schedules = []
+    for trigger in plan.triggers or []:
+        # Scheduled triggers are the only ones with a cron expression
+        if getattr(trigger, 'cronExpression', None):
+            try:
+                cron_expression = staggered_cron(trigger.cronExpression, plan_key, window_minutes)
+            except ValueError as e:
+                print('WARNING: %s in plan %s' % (e, plan_key), file=sys.stderr)
+                continue
+            start_minute = cron_start_minute(cron_expression)
+            schedules.append({
+                'plan_key': plan_key,
+                'trigger_name': trigger.name,
+                'enabled': trigger.enabled,
+                'bamboo_cron': trigger.cronExpression,
+                'staggered_cron': cron_expression,
+                'travis_interval': travis_cron_interval(cron_expression),
+                'start_time': '%02d:%02d' % (start_minute // 60, start_minute % 60) if start_minute is not None else '',
+            })
+    return schedules
+
+def schedule_yaml_lines(plan, context=None):
+    """Comments describing the Travis cron jobs to create for the plan's scheduled triggers.
+
+    Travis cron jobs are configured in the repository settings rather than .travis.yml, and run at
+    about the time of day they were created.
+    """
+    schedules = [schedule for schedule in plan_schedules(plan, context) if schedule['enabled'] is not False]
+    if not schedules:
+        return []
+    output_lines = ['# Scheduled builds, to be created as Travis cron jobs in the repository settings:']
+    for schedule in schedules:
+        # Weekly and monthly Travis cron jobs run on the day of the week or month they were created
+        fields = parse_cron(schedule['staggered_cron'])
+        monthly_day = ' on day %s' % (fields['day_of_month']) if not _is_any(fields['day_of_month']) else ' on %s' % (fields['day_of_week'])
+        start_day = {'weekly': ' on %s' % (fields['day_of_week']), 'monthly': monthly_day}.get(schedule['travis_interval'], '')
+        start_time = ' at %s' % (schedule['start_time']) if schedule['start_time'] else ''
+        output_lines.append('#   %s%s%s (Bamboo trigger "%s", cron %s)' % (schedule['travis_interval'], start_day, start_time,
+                                                                       schedule['trigger_name'], schedule['bamboo_cron']))
+    output_lines.append('')
+    return output_lines
@@ -0,0 +1,43 @@
+import csv
+import hashlib
+import re
+
+# Columns identifying each row written by plans.py, branches.py and results.py, in the order rows are
+# sorted by when merging shards. The last column is unique to a row and is used to remove duplicates.
+MERGE_KEY_COLUMNS = {
+    'plans': (0, 2),
+    'branches': (0, 2),
+    'results': (0, 2, 5),
+}
+
+
+def parse_shard(shard_spec):
+    """Parse a shard given as i/N, where 1 <= i <= N, returning the zero-based index and shard count."""
+    match = re.match(r'^(\d+)/(\d+)$', shard_spec or '')
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError('Invalid shard %s, expected i/N with 1 <= i <= N' % (shard_spec))
+    return int(match.group(1)) - 1, int(match.group(2))
+
+def in_shard(plan_key, shard):
+    """Return whether a plan belongs to the given shard, as returned by parse_shard, or True if shard is None.
+
+    Plans are assigned by a hash of their key, so every node agrees on the partitioning.
+    """
+    if shard is None:
+        return True
+    shard_index, shard_count = shard
+    return int(hashlib.sha1(plan_key.encode('utf-8')).hexdigest(), 16) % shard_count == shard_index
+
+def _natural_key(value):
+    # Sort build numbers (e.g. PROJ-PLAN-9 before PROJ-PLAN-10) and other numbers by value
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'(\d+)', value)]
+
+def merge_rows(file_paths, key_columns):
+    """Read the CSV rows of all files, returning them sorted by key_columns with duplicates removed."""
+    rows = {}
+    for file_path in file_paths:
+        with open(file_path, newline='') as csv_file:
+            for csv_row in csv.reader(csv_file):
+                if len(csv_row) > max(key_columns):
+                    rows[csv_row[key_columns[-1]]] = csv_row
+    return sorted(rows.values(), key=lambda csv_row: [_natural_key(csv_row[column]) for column in key_columns])
@@ -0,0 +1,58 @@
+import json
+
+from lib.files import write_atomic
+
+DEFAULT_STATE_FILE = '.migration-state.json'
+
+
+class StateStore():
+    """Fingerprints recorded by previous runs, grouped into named sections and persisted as JSON."""
+
+    def __init__(self, file_path=DEFAULT_STATE_FILE):
+        self.file_path = file_path
+        try:
+            with open(file_path, 'r') as state_file:
+                self.sections = json.load(state_file)
+        except FileNotFoundError:
+            self.sections = {}
+
+    def get(self, section, key, default_value=None):
+        return self.sections.get(section, {}).get(key, default_value)
+
+    def set(self, section, key, fingerprint):
+        self.sections.setdefault(section, {})[key] = fingerprint
+
+    def remove(self, section, key):
+        self.sections.get(section, {}).pop(key, None)
+
+    def keys(self, section):
+        return set(self.sections.get(section, {}).keys())
+
+    def save(self):
+        write_atomic(self.file_path, json.dumps(self.sections, indent=2, sort_keys=True) + '\n')
+
+
+class ChangeReport():
+
+    def __init__(self):
+        self.added = []
+        self.changed = []
+        self.unchanged = []
+        self.removed = []
+        self.failed = []
+
+    def record(self, key, previous_fingerprint, fingerprint):
+        if previous_fingerprint is None:
+            self.added.append(key)
+        elif previous_fingerprint != fingerprint:
+            self.changed.append(key)
+        else:
+            self.unchanged.append(key)
+
+    def summary_lines(self):
+        lines = ['%s %s' % (label, key) for label, keys in (('Added', self.added), ('Changed', self.changed), ('Removed', self.removed), ('Failed', self.failed))
+                 for key in sorted(keys)]
+        lines.append('%s added, %s changed, %s removed, %s unchanged' % (len(self.added), len(self.changed), len(self.removed), len(self.unchanged)))
+        if self.failed:
+            lines[-1] += ', %s failed' % (len(self.failed))
+        return lines
@@ -1,8 +1,17 @@
+import hashlib
+import json
+import math
 import operator
+import os
 import re
+import sys
 
 from functools import reduce
 
+from lib.files import write_atomic
+from lib.results import sheets_time_to_seconds
+from lib.schedule import schedule_yaml_lines
+
 
 # Mapping of Bamboo JVM versions to Travis equivalents
 jvm_versions = (
@@ -49,71 +58,360 @@ class CommandGroup():
         return output_lines
 
     def replace_cmd_parameters(self, plan, context=None):
-        repo_name_to_urls = dict((getattr(repo['repositoryDefinition'], 'parent') or getattr(repo['repositoryDefinition'], 'name'), repo['repositoryDefinition'].git_url(context)) for repo in plan.repositories)
-        self.cmds = [re.sub('\[repo\:([\w\.\-_ ]+)\]', lambda match: repo_name_to_urls[match.group(1)], cmd) for cmd in self.cmds]
+        alias_parameters = repository_alias_parameters(repository_aliases(plan))
+        repo_parameters = repository_parameters(plan, context)
+        self.cmds = [replace_repo_parameters(replace_repo_parameters(cmd, alias_parameters), repo_parameters) for cmd in self.cmds]
 
     @classmethod
     def _replace_repo_parameters(cls, match):
         return '%s' % ()
 
 
+# Commands which need more of the repository history than a shallow clone provides
+HISTORY_COMMANDS_PATTERN = re.compile('\\bgit\\s+(log|describe|rev-list|merge-base|blame|shortlog|tag)\\b|release:(prepare|perform)|jgitflow|git-commit-id')
+
+# Depth of the main checkout, enough to still contain the commit being built if a few more are pushed while it is queued
+MAIN_CHECKOUT_DEPTH = 10
+
+def needs_history(lines):
+    return any(HISTORY_COMMANDS_PATTERN.search(line) for line in lines)
+
+# References to plan repositories in the commands of converted tasks, resolved once the whole plan is converted
+REPO_PARAMETERS = ('repo', 'clone-options')
+REPO_PARAMETER_PATTERN = re.compile('\\[(repo|clone-options)\\:([\\w\\.\\-_ #]+)\\]')
+
+def repository_name(repository_definition):
+    return getattr(repository_definition, 'parent', None) or getattr(repository_definition, 'name')
+
+def normalise_repository_name(name):
+    # Checkout tasks do not always spell a repository name the same way as its definition
+    return ' '.join(name.split()).lower()
+
+def repository_aliases(plan):
+    """Map the normalised name of each repository of the plan to the alias job fragments refer to it by.
+
+    Aliases are positions in the plan's repository list, so the same job checking out the
+    corresponding repositories of two plans converts to the same fragment.
+    """
+    return dict((normalise_repository_name(repository_name(repo['repositoryDefinition'])), '#%s' % (index))
+                for index, repo in enumerate(plan.repositories))
+
+def repository_alias_parameters(aliases):
+    return dict((parameter, dict((name, '[%s:%s]' % (parameter, alias)) for name, alias in aliases.items()))
+                for parameter in REPO_PARAMETERS)
+
+def repository_urls(plan, context=None):
+    return dict(('#%s' % (index), repo['repositoryDefinition'].git_url(context)) for index, repo in enumerate(plan.repositories))
+
+def repository_clone_options(plan, full_history=False):
+    clone_options = {}
+    for index, repo in enumerate(plan.repositories):
+        branch = getattr(repo['repositoryDefinition'], 'branch', None)
+        options = [] if full_history else ['--depth 1', '--single-branch']
+        if branch:
+            options.append('--branch "%s"' % (branch,))
+        clone_options['#%s' % (index)] = ' '.join(options)
+    return clone_options
+
+def repository_parameters(plan, context=None, full_history=False):
+    """Values of the [repo:] and [clone-options:] references of the plan's commands, keyed by repository alias."""
+    return {'repo': repository_urls(plan, context), 'clone-options': repository_clone_options(plan, full_history)}
+
+def replace_repo_parameters(text, repo_parameters):
+    def replace_parameter(match):
+        value = repo_parameters[match.group(1)].get(normalise_repository_name(match.group(2)))
+        # References to repositories the plan does not have are left for the user to fix
+        return value if value is not None else match.group(0)
+    replaced_text = REPO_PARAMETER_PATTERN.sub(replace_parameter, text)
+    # Tidy up after clone options which expand to nothing
+    return replaced_text.replace('git clone  ', 'git clone ')
+
+
+def _canonical_value(value, repository_aliases=None):
+    canonical_value = dict(vars(value), __type__=type(value).__name__)
+    if repository_aliases is not None and canonical_value.get('checkoutItems'):
+        # Checkouts are compared by repository alias, so jobs only differing in repository share a key
+        canonical_value['checkoutItems'] = [
+            dict(item, repository=dict(item['repository'], name=repository_aliases.get(normalise_repository_name(item['repository']['name']), item['repository']['name'])))
+            if item.get('repository') and item['repository'].get('name') else item
+            for item in canonical_value['checkoutItems']]
+    return canonical_value
+
+def converter_version():
+    # Output generated by a different version of the converter must not be reused
+    version_hash = hashlib.sha256()
+    for module_name in ('bamboo.py', 'schedule.py', 'travis.py'):
+        with open(os.path.join(os.path.dirname(__file__), module_name), 'rb') as module_file:
+            version_hash.update(module_file.read())
+    return version_hash.hexdigest()
+
+
+class JobFragmentCache():
+    """Serialised Travis job bodies keyed by a canonical hash of the Bamboo job they were generated from.
+
+    Fragments refer to repositories by alias and are stored before those references are resolved, so
+    identical jobs from plans that only differ in their repositories share a single entry. If a file path is given, fragments
+    are loaded from and saved to that file so that they can be reused across runs.
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.fragments = {}
+        self.hits = 0
+        self.misses = 0
+        if file_path is not None:
+            try:
+                with open(file_path, 'r') as cache_file:
+                    cache_data = json.load(cache_file)
+                if cache_data.get('version') == converter_version():
+                    self.fragments = cache_data['fragments']
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def job_key(cls, job, extra=None, repository_aliases=None):
+        job_data = {'enabled': job['enabled'], 'tasks': job['tasks'], 'artifacts': job['artifacts'], 'extra': extra}
+        return hashlib.sha256(json.dumps(job_data, default=lambda value: _canonical_value(value, repository_aliases),
+                                         sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return fragment
+
+    def put(self, key, fragment):
+        self.fragments[key] = fragment
+
+    def save(self):
+        if self.file_path is not None:
+            write_atomic(self.file_path, json.dumps({'version': converter_version(), 'fragments': self.fragments}))
+
+
+def _merge_unique(items, new_items):
+    return items + [item for item in new_items if item not in items]
+
+def _workspace_name(artifact_names):
+    return re.sub('[^\\w\\-]+', '-', '-'.join(sorted(artifact_names))).strip('-').lower()
+
+def shared_artifact_workspaces(plan):
+    """Map the name of each shared artifact in the plan to the Travis workspace of the job producing it, and its stage."""
+    plan_workspaces = {}
+    for stage_index, stage in enumerate(plan.stages):
+        for job in stage['jobs']:
+            shared_artifacts = [artifact for artifact in job['artifacts'] or [] if artifact.get('shared')]
+            workspace_name = _workspace_name([artifact['name'] for artifact in shared_artifacts])
+            for artifact in shared_artifacts:
+                copy_source = artifact['copyPattern']
+                if artifact['location']:
+                    copy_source = artifact['location'] + '/' + copy_source
+                # Workspaces are made of whole paths, so globs are covered by the directory they apply to
+                workspace_path = copy_source if not re.search('[\\*\\?\\[]', copy_source) else (artifact['location'] or '.')
+                plan_workspaces[artifact['name']] = {'name': workspace_name, 'path': workspace_path, 'copy_source': copy_source,
+                                                  'stage': stage_index}
+    return plan_workspaces
+
+def job_workspaces(job, plan_workspaces, stage_index):
+    """The workspaces of the plan a job creates or downloads artifacts from, which are all its fragment depends on."""
+    artifact_names = set(artifact['name'] for artifact in job['artifacts'] or [])
+    for task in job['tasks']:
+        if hasattr(task, 'get_artifact_names'):
+            artifact_names.update(task.get_artifact_names(plan_workspaces))
+    # Only whether a workspace comes from an earlier stage matters, not which one
+    return dict((artifact_name, dict(plan_workspaces[artifact_name], stage=None, earlier_stage=plan_workspaces[artifact_name]['stage'] < stage_index))
+                for artifact_name in artifact_names if artifact_name in plan_workspaces)
+
+def workspace_yaml_lines(create_name, create_paths, use_names, prefix='      '):
+    output_lines = ['%sworkspaces:' % (prefix)]
+    if create_name:
+        output_lines.append('%s  create:' % (prefix))
+        output_lines.append('%s    name: %s' % (prefix, create_name))
+        output_lines.append('%s    paths:' % (prefix))
+        output_lines += ['%s      - %s' % (prefix, path) for path in create_paths]
+    if use_names:
+        output_lines.append('%s  use:' % (prefix))
+        output_lines += ['%s    - %s' % (prefix, name) for name in use_names]
+    return output_lines
+
+def fragment_workspace_lines(fragment, create=True):
+    workspaces = fragment.get('workspaces')
+    if workspaces is None or not (create and workspaces['create_name'] or workspaces['use_names']):
+        return []
+    return workspace_yaml_lines(workspaces['create_name'] if create else None, workspaces['create_paths'], workspaces['use_names'], workspaces['prefix'])
+
+def _shardable_task(task):
+    return hasattr(task, 'get_sharded_jobs') and getattr(task, 'hasTests', False) and getattr(task, 'enabled', True)
+
+def job_fragment(job, shard_tests=False, plan_workspaces=None, plan_key=None, repository_aliases=None, stage_index=0):
+    task_languages = []
+    task_services = []
+    task_cache = {'directories': [], 'before_cache': []}
+    uses_artifacts = False
+    sharded = False
+    used_workspaces = []
+    output_lines = []
+    all_travis_jobs = {}
+    alias_parameters = repository_alias_parameters(repository_aliases or {})
+    for task in job['tasks']:
+        if plan_workspaces is not None and hasattr(task, 'get_workspace_jobs'):
+            travis_jobs, workspace_names = task.get_workspace_jobs(plan_workspaces, plan_key, stage_index)
+            if job['enabled'] and getattr(task, 'enabled', True):
+                used_workspaces = _merge_unique(used_workspaces, workspace_names)
+            if not travis_jobs:
+                continue
+        elif shard_tests and _shardable_task(task):
+            travis_jobs = task.get_sharded_jobs()
+            sharded = True
+        else:
+            travis_jobs = task.get_jobs()
+        all_commands = reduce(operator.add, travis_jobs.values())
+        if len(all_commands) == 0:
+            continue
+        if hasattr(task, 'get_language'):
+            task_languages.append(task.get_language())
+        if hasattr(task, 'get_services'):
+            task_services += task.get_services()
+        is_enabled = job['enabled'] and getattr(task, 'enabled', True)
+        if hasattr(task, 'get_cache') and is_enabled:
+            for cache_key, cache_values in task.get_cache().items():
+                task_cache[cache_key] = _merge_unique(task_cache[cache_key], cache_values)
+        # Combine jobs from each Bamboo task into a single Travis job
+        for phase, cmds in travis_jobs.items():
+            if isinstance(cmds, str):
+                cmds = [cmds]
+            cmds = [replace_repo_parameters(cmd, alias_parameters) for cmd in cmds]
+            group = CommandGroup(cmds, getattr(task, 'description', ''), is_enabled)
+            all_travis_jobs[phase] = all_travis_jobs.get(phase, []) + [group]
+
+    if job['artifacts']:
+        uses_artifacts = True
+        artifacts_cmds = []
+        for artifact in job['artifacts']:
+            artifact_path = artifact['copyPattern']
+            if artifact['location']:
+                artifact_path = artifact['location'] + '/' + artifact_path
+            if sharded:
+                # Every shard builds the same artifacts, so only the first one uploads them
+                artifacts_cmds.append('if [ "$TEST_SHARD" = "0" ]; then artifacts upload %s; fi' % (artifact_path,))
+            else:
+                artifacts_cmds.append('artifacts upload %s' % (artifact_path,))
+        group = CommandGroup(artifacts_cmds, 'Push artifacts to S3', job['enabled'])
+        all_travis_jobs['after_script'] = all_travis_jobs.get('after_script', []) + [group]
+
+    for phase, cmd_groups in all_travis_jobs.items():
+        phase_prefix = '      ' if job['enabled'] else '      # '
+        output_lines.append('%s%s:' % (phase_prefix, phase))
+        for cmd_group in cmd_groups:
+            output_lines.extend(cmd_group.serialise_lines())
+
+    # Workspaces are kept apart from the other lines, as only one shard of a sharded job may create them
+    workspaces = None
+    if plan_workspaces is not None:
+        created_workspace = [workspace for artifact_name, workspace in sorted(plan_workspaces.items())
+                             if artifact_name in [artifact['name'] for artifact in job['artifacts'] or []]]
+        if created_workspace or used_workspaces:
+            workspaces = {'create_name': created_workspace[0]['name'] if created_workspace else None,
+                          'create_paths': _merge_unique([], [workspace['path'] for workspace in created_workspace]),
+                          'use_names': used_workspaces,
+                          'prefix': '      ' if job['enabled'] else '      # '}
+
+    return {'lines': output_lines, 'languages': task_languages, 'services': task_services, 'artifacts': uses_artifacts,
+            'cache': task_cache, 'sharded': sharded, 'workspaces': workspaces}
+
+
+def test_shard_count(plan, context=None):
+    context = context or {}
+    return context.get('plan_test_shards', {}).get(plan.full_key(), context.get('test_shards', 1))
+
+def stage_job_counts(plan, context=None):
+    """Return the number of Travis jobs each stage of the plan is converted into, counting test shards."""
+    test_shards = test_shard_count(plan, context)
+    return [sum(test_shards if test_shards > 1 and job['enabled'] and any(_shardable_task(task) for task in job['tasks']) else 1
+                for job in stage['jobs'])
+            for stage in plan.stages]
+
+def plan_test_shards(result_rows, target_minutes, max_shards):
+    """Choose a number of test shards per plan from its historical build durations.
+
+    Uses the median duration of successful builds of each plan's default branch, aiming for shards
+    of roughly target_minutes each.
+    """
+    durations = {}
+    for result_row in result_rows:
+        if result_row['branch_name'] == '' and result_row['successful'] == 'True':
+            durations.setdefault(result_row['plan_key'], []).append(sheets_time_to_seconds(result_row['duration']))
+    shard_counts = {}
+    for plan_key, plan_durations in durations.items():
+        median_minutes = sorted(plan_durations)[len(plan_durations) // 2] / 60
+        shard_counts[plan_key] = max(1, min(max_shards, int(math.ceil(median_minutes / target_minutes))))
+    return shard_counts
+
+
 def jobs_yaml_lines(source_plan, context=None):
     output_lines = []
     task_languages = []
     task_services = []
     task_addons = {}
+    task_cache = {'directories': [], 'before_cache': []}
     name_prefix = '      '
-    for stage in source_plan.stages:
+    job_cache = (context or {}).get('job_cache')
+    test_shards = test_shard_count(source_plan, context)
+    plan_workspaces = shared_artifact_workspaces(source_plan)
+    plan_key = source_plan.full_key()
+    plan_repository_aliases = repository_aliases(source_plan)
+    for stage_index, stage in enumerate(source_plan.stages):
         if stage['description']:
             output_lines.append('    # Stage: %s' % (stage['description']))
         if stage['finalStage'] is True:
             output_lines.append('    # BAMBOO FINAL STAGE - SHOULD RUN REGARDLESS OF STATUS OF OTHER STAGES')
         for job in stage['jobs']:
-            output_lines.append('    - stage: "%s"' % (stage['name']))
-            output_lines.append('%sname: "%s"' % (name_prefix, job['name']))
-            all_travis_jobs = {}
-            for task in job['tasks']:
-                travis_jobs = task.get_jobs()
-                all_commands = reduce(operator.add, travis_jobs.values())
-                if len(all_commands) == 0:
-                    continue
-                if hasattr(task, 'get_language'):
-                    task_languages.append(task.get_language())
-                if hasattr(task, 'get_services'):
-                    task_services += task.get_services()
-                # Combine jobs from each Bamboo task into a single Travis job
-                for phase, cmds in travis_jobs.items():
-                    if isinstance(cmds, str):
-                        cmds = [cmds]
-                    is_enabled = job['enabled'] and getattr(task, 'enabled', True)
-                    group = CommandGroup(cmds, getattr(task, 'description', ''), is_enabled)
-                    group.replace_cmd_parameters(source_plan, context)
-                    all_travis_jobs[phase] = all_travis_jobs.get(phase, []) + [group]
-
-            if job['artifacts']:
+            shard_tests = test_shards > 1 and job['enabled']
+            # Artifact downloads only resolve against the plan itself if they name it as their source
+            downloads_artifacts = any(hasattr(task, 'get_workspace_jobs') for task in job['tasks'])
+            if job_cache is not None:
+                cache_key = JobFragmentCache.job_key(job, {'shard_tests': shard_tests, 'workspaces': job_workspaces(job, plan_workspaces, stage_index),
+                                                           'plan_key': plan_key if downloads_artifacts else None},
+                                             plan_repository_aliases)
+                fragment = job_cache.get(cache_key)
+                if fragment is None:
+                    fragment = job_fragment(job, shard_tests, plan_workspaces, plan_key, plan_repository_aliases, stage_index)
+                    job_cache.put(cache_key, fragment)
+            else:
+                fragment = job_fragment(job, shard_tests, plan_workspaces, plan_key, plan_repository_aliases, stage_index)
+            fragment_lines = fragment['lines']
+            if fragment['sharded']:
+                # Run the same job once per shard, each selecting its own subset of the tests
+                for shard_index in range(test_shards):
+                    output_lines.append('    - stage: "%s"' % (stage['name']))
+                    output_lines.append('%sname: "%s (shard %s/%s)"' % (name_prefix, job['name'], shard_index + 1, test_shards))
+                    output_lines.append('%senv: TEST_SHARD=%s TEST_SHARDS=%s' % (name_prefix, shard_index, test_shards))
+                    output_lines += fragment_lines
+                    output_lines += fragment_workspace_lines(fragment, create=shard_index == 0)
+            else:
+                output_lines.append('    - stage: "%s"' % (stage['name']))
+                output_lines.append('%sname: "%s"' % (name_prefix, job['name']))
+                output_lines += fragment_lines
+                output_lines += fragment_workspace_lines(fragment)
+            task_languages += fragment['languages']
+            task_services += fragment['services']
+            if fragment['artifacts']:
                 task_addons['artifacts'] = True
-                artifacts_cmds = []
-                for artifact in job['artifacts']:
-                    artifact_path = artifact['copyPattern']
-                    if artifact['location']:
-                        artifact_path = artifact['location'] + '/' + artifact_path
-                    artifacts_cmds.append('artifacts upload %s' % (artifact_path,))
-                group = CommandGroup(artifacts_cmds, 'Push artifacts to S3', job['enabled'])
-                group.replace_cmd_parameters(source_plan, context)
-                all_travis_jobs['after_script'] = all_travis_jobs.get('after_script', []) + [group]
-
-            for phase, cmd_groups in all_travis_jobs.items():
-                phase_prefix = '      ' if job['enabled'] else '      # '
-                output_lines.append('%s%s:' % (phase_prefix, phase))
-                for cmd_group in cmd_groups:
-                    output_lines.extend(cmd_group.serialise_lines())
-                    
-    return output_lines, task_languages, task_services, task_addons
+            # Travis caches are configured once for the whole build, so merge those of every job
+            for cache_name, cache_values in fragment['cache'].items():
+                task_cache[cache_name] = _merge_unique(task_cache[cache_name], cache_values)
+
+    # Repository references are only resolved once the whole plan is known to need full clones or not. Only
+    # the aliases fragments give them are resolved, so references in descriptions are left as written.
+    repo_parameters = repository_parameters(source_plan, context, needs_history(output_lines))
+    output_lines = [replace_repo_parameters(line, repo_parameters) for line in output_lines]
+    return output_lines, task_languages, task_services, task_addons, task_cache
 
 def generate_yaml(plan, context=None):
-    output_lines = []
+    output_lines = schedule_yaml_lines(plan, context)
     dist_os = 'xenial'
-    job_output_lines, job_languages, job_services, job_addons = jobs_yaml_lines(plan, context)
+    job_output_lines, job_languages, job_services, job_addons, job_cache = jobs_yaml_lines(plan, context)
     if len(job_languages):
         language_names = [ language[0] for language in job_languages ]
         for travis_language_name in ['java', 'node_js']:
@@ -123,10 +421,10 @@ def generate_yaml(plan, context=None):
                 if travis_language_name == 'java':
                     mentioned_jdks = set([ language[1] for language in job_languages if language[0] == 'java' ])
                     if len(mentioned_jdks) > 1:
-                        print('WARNING: Multiple JDK versions spefified: %s' % (mentioned_jdks))
+                        print('WARNING: Multiple JDK versions spefified: %s' % (mentioned_jdks), file=sys.stderr)
                     travis_jdk = dict(jvm_versions).get(sorted(list(mentioned_jdks))[-1])
                     if travis_jdk == 'oraclejdk7':
-                        print('WARNING: oraclejdk7 is no longer available, using oraclejdk8 instead')
+                        print('WARNING: oraclejdk7 is no longer available, using oraclejdk8 instead', file=sys.stderr)
                         travis_jdk = 'oraclejdk8'
                         dist_os = 'trusty'
                     if travis_jdk == 'oraclejdk8':
@@ -145,6 +443,9 @@ def generate_yaml(plan, context=None):
                 break
     output_lines.append('dist: %s' % (dist_os))
     output_lines.append('')
+    output_lines.append('git:')
+    output_lines.append('  depth: %s' % ('false' if needs_history(job_output_lines) else MAIN_CHECKOUT_DEPTH))
+    output_lines.append('')
     if len(job_services):
         output_lines.append('services:')
         for service_name in job_services:
@@ -155,6 +456,16 @@ def generate_yaml(plan, context=None):
         for addon_name, addon_value in job_addons.items():
             output_lines.append(('  %s: %s' % (addon_name, addon_value)).lower())
         output_lines.append('')
+    if len(job_cache['directories']):
+        output_lines.append('cache:')
+        output_lines.append('  directories:')
+        for cache_directory in job_cache['directories']:
+            output_lines.append('    - %s' % cache_directory)
+        output_lines.append('')
+    if len(job_cache['before_cache']):
+        output_lines.append('before_cache:')
+        output_lines += CommandGroup(job_cache['before_cache']).serialise_lines(indent=2)
+        output_lines.append('')
     output_lines.append('stages:')
     for stage in plan.stages:
         output_lines.append('  - name: %s' % (stage['name']))
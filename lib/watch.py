@@ -0,0 +1,120 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_DEBOUNCE_SECONDS = 0.5
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+
+
+def is_plan_file(file_name):
+    # Skip hidden files, including the temporary files written by lib.files.write_atomic, and editor backups
+    return not file_name.startswith('.') and not file_name.endswith('~') and not file_name.endswith('.swp')
+
+
+class InotifyWatcher():
+
+    def __init__(self, dir_path):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % (dir_path))
+
+    def changes(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed_names = set()
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            name_start = offset + EVENT_HEADER.size
+            file_name = os.fsdecode(buffer[name_start:name_start + name_length].rstrip(b'\0'))
+            if file_name and is_plan_file(file_name):
+                changed_names.add(file_name)
+            offset = name_start + name_length
+        return changed_names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher():
+
+    def __init__(self, dir_path, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS):
+        self.dir_path = dir_path
+        self.poll_interval = poll_interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for file_name in os.listdir(self.dir_path):
+            if is_plan_file(file_name):
+                try:
+                    file_stat = os.stat(os.path.join(self.dir_path, file_name))
+                    snapshot[file_name] = (file_stat.st_mtime_ns, file_stat.st_size)
+                except FileNotFoundError:
+                    pass
+        return snapshot
+
+    def changes(self, timeout=None):
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        new_snapshot = self._snapshot()
+        changed_names = set(file_name for file_name in set(self.snapshot) | set(new_snapshot)
+                            if self.snapshot.get(file_name) != new_snapshot.get(file_name))
+        self.snapshot = new_snapshot
+        return changed_names
+
+    def close(self):
+        pass
+
+
+def create_watcher(dir_path, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS):
+    try:
+        return InotifyWatcher(dir_path)
+    except (OSError, AttributeError):
+        return PollingWatcher(dir_path, poll_interval)
+
+
+def watch_directory(dir_path, on_change, debounce=DEFAULT_DEBOUNCE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS):
+    """Call on_change with the set of names of files changed, added or removed in dir_path, forever.
+
+    Changes are collected until none have been seen for debounce seconds, so that a burst of saves
+    results in a single call.
+    """
+    watcher = create_watcher(dir_path, poll_interval)
+    try:
+        pending_names = set()
+        while True:
+            changed_names = watcher.changes(debounce if pending_names else None)
+            if changed_names:
+                pending_names |= changed_names
+            elif pending_names:
+                on_change(pending_names)
+                pending_names = set()
+    finally:
+        watcher.close()
@@ -0,0 +1,24 @@
+#!/usr/bin/python
+
+import csv
+import getopt
+import sys
+
+from lib.shard import MERGE_KEY_COLUMNS, merge_rows
+
+USAGE = '''Usage: merge-shards.py [--type=plans|branches|results] SHARD_CSV...
+
+Combines the CSV files written by plans.py, branches.py or results.py (default) run with --shard
+into a single CSV file on stdout, ordered by plan, branch and build and with duplicate rows removed.
+'''
+
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], '', ['type='])
+    opts = dict(optlist)
+    row_type = opts.get('--type', 'results')
+    if len(args) == 0 or row_type not in MERGE_KEY_COLUMNS:
+        print(USAGE)
+        exit(1)
+
+    csv.writer(sys.stdout).writerows(merge_rows(args, MERGE_KEY_COLUMNS[row_type]))
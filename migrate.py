@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import os
+import shlex
+import sys
+import traceback
+
+# Subcommands and the scripts implementing them
+COMMANDS = {
+    'plans': 'plans.py',
+    'branches': 'branches.py',
+    'results': 'results.py',
+    'export-plans': 'export-plans.py',
+    'convert': 'bamboo-to-travis.py',
+    'plan-index': 'plan-index.py',
+    'plan-store': 'plan-store.py',
+    'analytics': 'analytics.py',
+    'merge-shards': 'merge-shards.py',
+    'simulate-capacity': 'simulate-capacity.py',
+    'sample-queue': 'sample-queue.py',
+}
+
+USAGE = '''Usage: migrate.py COMMAND [ARGS]
+       migrate.py --batch [FILE]
+
+Commands: %s
+
+Each command takes the same arguments as the script implementing it. With --batch, commands are
+read one per line from FILE (or stdin) and all run within a single process.
+''' % (', '.join(sorted(COMMANDS.keys())))
+
+compiled_scripts = {}
+
+
+def compile_script(script_name):
+    # Scripts are compiled once and re-executed for every command using them
+    if script_name not in compiled_scripts:
+        script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script_name)
+        with open(script_path, 'r') as script_file:
+            compiled_scripts[script_name] = (script_path, compile(script_file.read(), script_path, 'exec'))
+    return compiled_scripts[script_name]
+
+def run_command(command, command_args):
+    script_name = COMMANDS.get(command) or (command if command in COMMANDS.values() else None)
+    if script_name is None:
+        print('Unknown command %s' % (command), file=sys.stderr)
+        return 1
+    script_path, script_code = compile_script(script_name)
+    saved_argv = sys.argv
+    sys.argv = [script_path] + command_args
+    try:
+        exec(script_code, {'__name__': '__main__', '__file__': script_path, '__builtins__': __builtins__})
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    finally:
+        sys.argv = saved_argv
+        sys.stdout.flush()
+
+def run_batch(batch_file):
+    failures = 0
+    # Read every command first, as the exit() builtin the scripts call closes stdin
+    for line_number, line in enumerate(batch_file.readlines(), 1):
+        command_line = shlex.split(line, comments=True)
+        if not command_line:
+            continue
+        try:
+            exit_code = run_command(command_line[0], command_line[1:])
+        except Exception:
+            # One failing command should not abort the rest of the batch
+            traceback.print_exc()
+            exit_code = 1
+        if exit_code:
+            failures += 1
+            print('Line %s: %s exited with status %s' % (line_number, line.strip(), exit_code), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print(USAGE)
+        exit(1)
+    if sys.argv[1] == '--batch':
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'r') as batch_file:
+                exit(run_batch(batch_file))
+        else:
+            exit(run_batch(sys.stdin))
+    exit(run_command(sys.argv[1], sys.argv[2:]))
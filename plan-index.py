@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+import csv
+import getopt
+import sys
+
+from lib.bamboo import LinkedRepositoriesList, configure_yaml_loader
+from lib.files import file_hash
+from lib.index import DEFAULT_INDEX_FILE, PlanIndex
+
+LINKED_REPOSITORIES_CSV_FILE = 'repositories.csv'
+
+USAGE = '''Usage: plan-index.py [--index=FILE] COMMAND [ARGS]
+
+Commands:
+  update [DIR]            index new and changed plan files in DIR (default plans)
+  repository NAME_OR_URL  plans using a repository
+  consumers PLAN_KEY      plans downloading artifacts from PLAN_KEY
+  sources PLAN_KEY        plans PLAN_KEY downloads artifacts from
+  triggers TYPE           plans with triggers of TYPE, e.g. RemoteTriggerProperties
+'''
+
+optlist, args = getopt.getopt(sys.argv[1:], '', ['index='])
+opts = dict(optlist)
+
+if len(args) == 0:
+    print(USAGE)
+    exit(1)
+
+writer = csv.writer(sys.stdout)
+index = PlanIndex(opts.get('--index', DEFAULT_INDEX_FILE))
+
+try:
+    command, command_args = args[0], args[1:]
+    if command == 'update':
+        configure_yaml_loader()
+        plan_context = {'linked_repositories': LinkedRepositoriesList(LINKED_REPOSITORIES_CSV_FILE)}
+        updated_files, removed_files = index.update(command_args[0] if command_args else 'plans', plan_context,
+                                                    file_hash(LINKED_REPOSITORIES_CSV_FILE) or '')
+        print('Indexed %s updated and %s removed plan files' % (len(updated_files), len(removed_files)))
+    elif command == 'repository' and len(command_args) == 1:
+        writer.writerows(index.plans_using_repository(command_args[0]))
+    elif command == 'consumers' and len(command_args) == 1:
+        writer.writerows(index.artifact_consumers(command_args[0]))
+    elif command == 'sources' and len(command_args) == 1:
+        writer.writerows(index.artifact_sources(command_args[0]))
+    elif command == 'triggers' and len(command_args) == 1:
+        writer.writerows(index.plans_with_trigger(command_args[0]))
+    else:
+        print(USAGE)
+        exit(1)
+except KeyboardInterrupt:
+    print('KeyboardInterrupt')
+finally:
+    index.close()
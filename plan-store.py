@@ -0,0 +1,42 @@
+#!/usr/bin/python
+
+import getopt
+import sys
+
+from lib.planstore import DEFAULT_STORE_FILE, PlanStore
+
+USAGE = '''Usage: plan-store.py [--store=FILE] COMMAND [ARGS]
+
+Commands:
+  import DIR   add new and changed plan files in DIR to the store
+  export DIR   write the plans in the store to DIR as individual files
+  list         list the plan keys and content hashes in the store
+'''
+
+optlist, args = getopt.getopt(sys.argv[1:], '', ['store='])
+opts = dict(optlist)
+
+if len(args) == 0:
+    print(USAGE)
+    exit(1)
+
+store = PlanStore(opts.get('--store', DEFAULT_STORE_FILE))
+
+try:
+    command, command_args = args[0], args[1:]
+    if command == 'import' and len(command_args) == 1:
+        imported_keys = store.import_directory(command_args[0])
+        print('Imported %s new or changed plans into %s' % (len(imported_keys), store.file_path))
+    elif command == 'export' and len(command_args) == 1:
+        exported_keys = store.export_directory(command_args[0])
+        print('Written %s new or changed plans to %s' % (len(exported_keys), command_args[0]))
+    elif command == 'list':
+        for plan_key in store.keys():
+            print('%s %s' % (plan_key, store.hash(plan_key)))
+    else:
+        print(USAGE)
+        exit(1)
+except KeyboardInterrupt:
+    print('KeyboardInterrupt')
+finally:
+    store.close()
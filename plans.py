@@ -1,31 +1,67 @@
 #!/usr/bin/python
 
 import csv
+import getopt
 import requests
 import sys
 
 from lib.config import get_or_create as get_or_create_config
-from lib.rest import REST_CONFIG_FIELDS, api_get
+from lib.rest import PLAN_EXPANSIONS, REST_CONFIG_FIELDS, api_get, expand_params
+from lib.shard import in_shard, parse_shard
 
 batch_size = 50
-offset = 0
+
+# Fields of each plan written by plan_row, which determine what is requested from Bamboo
+PLAN_FIELDS = ['project.key', 'project.name', 'key', 'shortName', 'enabled']
+
+optlist, args = getopt.getopt(sys.argv[1:], '', ['async', 'concurrency=', 'shard='])
+opts = dict(optlist)
+try:
+    shard = parse_shard(opts['--shard']) if '--shard' in opts else None
+except ValueError as e:
+    print(e)
+    exit(1)
 
 config = get_or_create_config('config.ini', 'bamboo', REST_CONFIG_FIELDS)
 auth = (config['username'], config['password'])
 base_path = config['url']
 writer = csv.writer(sys.stdout)
 
-while True:
-    try:
-        r = api_get('/plan', {'expand': 'plans.plan.branches', 'max-result': batch_size, 'start-index': offset},
-                    base_path=base_path, auth=auth)
-        response_plans = r.json()['plans']
-        plans = response_plans['plan']
-        for plan in plans:
-            writer.writerow([plan['project']['key'], plan['project']['name'], plan['key'], plan['shortName'], plan['enabled'],])
-        offset += batch_size
-        if offset >= response_plans['size']:
+def plan_row(plan):
+    return [plan['project']['key'], plan['project']['name'], plan['key'], plan['shortName'], plan['enabled'],]
+
+def dump_plans():
+    offset = 0
+    while True:
+        try:
+            params = dict(expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), **{'max-result': batch_size, 'start-index': offset})
+            r = api_get('/plan', params,
+                        base_path=base_path, auth=auth)
+            response_plans = r.json()['plans']
+            plans = response_plans['plan']
+            for plan in plans:
+                if in_shard(plan['key'], shard):
+                    writer.writerow(plan_row(plan))
+            offset += batch_size
+            if offset >= response_plans['size']:
+                break
+        except requests.exceptions.HTTPError as e:
+            print(e)
             break
-    except requests.exceptions.HTTPError as e:
-        print(e)
-        break
+
+async def dump_plans_async(concurrency):
+    from lib.aiorest import AsyncApiClient
+    async with AsyncApiClient(base_path, auth, concurrency) as client:
+        async for response_plans in client.api_get_paged('/plan', expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), 'plans', batch_size):
+            for plan in response_plans['plan']:
+                if in_shard(plan['key'], shard):
+                    writer.writerow(plan_row(plan))
+
+try:
+    if '--async' in opts:
+        from lib.aiorest import DEFAULT_CONCURRENCY, run
+        run(dump_plans_async(int(opts.get('--concurrency', DEFAULT_CONCURRENCY))))
+    else:
+        dump_plans()
+except KeyboardInterrupt:
+    print('KeyboardInterrupt')
@@ -1,10 +1,26 @@
 #!/usr/bin/python
 
+import asyncio
 import csv
+import getopt
 import sys
 
 from lib.config import get_or_create as get_or_create_config
-from lib.rest import REST_CONFIG_FIELDS, api_get_paged
+from lib.rest import PLAN_EXPANSIONS, RESULT_EXPANSIONS, REST_CONFIG_FIELDS, api_get_paged, expand_params
+from lib.shard import in_shard, parse_shard
+
+# Fields read from each plan and result when writing rows, which determine what is requested from Bamboo.
+# The plan and branch columns are taken from the plan list, so the plan of each result is not needed.
+PLAN_FIELDS = ['key', 'shortName', 'enabled', 'branches.key', 'branches.shortName', 'branches.enabled']
+RESULT_FIELDS = ['buildResultKey', 'buildCompletedDate', 'buildDurationInSeconds', 'lifeCycleState', 'successful', 'buildReason']
+
+optlist, args = getopt.getopt(sys.argv[1:], '', ['async', 'concurrency=', 'shard='])
+opts = dict(optlist)
+try:
+    shard = parse_shard(opts['--shard']) if '--shard' in opts else None
+except ValueError as e:
+    print(e)
+    exit(1)
 
 config = get_or_create_config('config.ini', 'bamboo', REST_CONFIG_FIELDS)
 auth = (config['username'], config['password'])
@@ -17,25 +33,43 @@ def date_to_sheets_format(iso_date):
 def seconds_to_sheets_time(time_secs):
     return time_secs / (24 * 3600)
 
-def result_row(last_result):
-    plan_key = last_result['plan']['master']['key'] if 'master' in last_result['plan'] else last_result['plan']['key']
-    plan_name = last_result['plan']['master']['shortName'] if 'master' in last_result['plan'] else last_result['plan']['shortName']
-    branch_key = last_result['plan']['key']
-    branch_name = last_result['plan']['shortName'] if 'master' in last_result['plan'] else ''
-    return [plan_key, plan_name, branch_key, branch_name, last_result['plan']['enabled'], last_result['buildResultKey'], date_to_sheets_format(last_result['buildCompletedDate']), seconds_to_sheets_time(last_result['buildDurationInSeconds']), last_result['lifeCycleState'], last_result['successful'], last_result['buildReason']]
+def result_row(branch_columns, last_result):
+    return branch_columns + [last_result['buildResultKey'], date_to_sheets_format(last_result['buildCompletedDate']), seconds_to_sheets_time(last_result['buildDurationInSeconds']), last_result['lifeCycleState'], last_result['successful'], last_result['buildReason']]
 
-def latest_result_row(results):
-    if len(results) > 0:
-        return result_row(results[0])
-    else:
-        return None
+def plan_branch_columns(plan):
+    """Return the plan key, plan name, branch key, branch name and enabled columns for the plan and each of its branches."""
+    return [[plan['key'], plan['shortName'], plan['key'], '', plan['enabled']]] + \
+        [[plan['key'], plan['shortName'], branch['key'], branch['shortName'], branch['enabled']] for branch in plan['branches']['branch']]
 
-for response_json in api_get_paged('/plan', {'expand': 'plans.plan.branches'}, 'plans', base_path=base_path, auth=auth):
-    plans = response_json['plan']
-    for plan in plans:
-        branch_keys = [plan['key']] + [branch['key'] for branch in plan['branches']['branch']]
-        for branch_key in branch_keys:
-            for results_repsonse in api_get_paged('/result/%s' % branch_key, {'expand': 'results.result.plan'}, 'results', base_path=base_path, auth=auth):
-                for result in results_repsonse['result']:
-                    writer.writerow(result_row(result))
+def dump_results():
+    for response_json in api_get_paged('/plan', expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), 'plans', base_path=base_path, auth=auth):
+        plans = [plan for plan in response_json['plan'] if in_shard(plan['key'], shard)]
+        for plan in plans:
+            for branch_columns in plan_branch_columns(plan):
+                for results_repsonse in api_get_paged('/result/%s' % branch_columns[2], expand_params(RESULT_FIELDS, RESULT_EXPANSIONS), 'results', base_path=base_path, auth=auth):
+                    for result in results_repsonse['result']:
+                        writer.writerow(result_row(branch_columns, result))
 
+async def branch_result_rows(client, branch_columns):
+    rows = []
+    async for results_response in client.api_get_paged('/result/%s' % branch_columns[2], expand_params(RESULT_FIELDS, RESULT_EXPANSIONS), 'results'):
+        rows += [result_row(branch_columns, result) for result in results_response['result']]
+    return rows
+
+async def dump_results_async(concurrency):
+    from lib.aiorest import AsyncApiClient
+    async with AsyncApiClient(base_path, auth, concurrency) as client:
+        async for response_json in client.api_get_paged('/plan', expand_params(PLAN_FIELDS, PLAN_EXPANSIONS), 'plans'):
+            all_branch_columns = [branch_columns for plan in response_json['plan'] if in_shard(plan['key'], shard) for branch_columns in plan_branch_columns(plan)]
+            # Page through the results of every branch in the page concurrently, writing rows in page order
+            for rows in await asyncio.gather(*[branch_result_rows(client, branch_columns) for branch_columns in all_branch_columns]):
+                writer.writerows(rows)
+
+try:
+    if '--async' in opts:
+        from lib.aiorest import DEFAULT_CONCURRENCY, run
+        run(dump_results_async(int(opts.get('--concurrency', DEFAULT_CONCURRENCY))))
+    else:
+        dump_results()
+except KeyboardInterrupt:
+    print('KeyboardInterrupt')
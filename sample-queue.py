@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+import csv
+import getopt
+import json
+import math
+import requests
+import sys
+import time
+
+from datetime import datetime
+
+from lib.config import get_or_create as get_or_create_config
+from lib.rest import REST_CONFIG_FIELDS
+from lib.sampler import DEFAULT_INTERVAL_SECONDS, ConditionalFetcher, DeltaEncoder, fetch_queue_state, read_samples
+
+DEFAULT_SAMPLES_FILE = 'queue-samples.jsonl'
+
+USAGE = '''Usage: sample-queue.py [--interval=SECONDS] [--duration=SECONDS] [--output=FILE]
+       sample-queue.py --decode [FILE]
+
+Samples the Bamboo build queue and agents every --interval seconds (default 10), appending the
+changes since the previous sample to FILE (default queue-samples.jsonl) until stopped with Ctrl-C or
+for --duration seconds. With --decode, writes one CSV row per sample with the numbers of queued
+builds, busy agents, online agents and enabled agents.
+'''
+
+
+def sample_queue(output_path, interval, duration=None):
+    config = get_or_create_config('config.ini', 'bamboo', REST_CONFIG_FIELDS)
+    # A sample still being fetched when the next one is due is given up, leaving a gap
+    fetcher = ConditionalFetcher(config['url'], (config['username'], config['password']), timeout=interval)
+    encoder = DeltaEncoder()
+    start_time = time.time()
+    slot = 0
+    with open(output_path, 'a') as samples_file:
+        while duration is None or slot * interval < duration:
+            sample_time = time.time()
+            try:
+                state = fetch_queue_state(fetcher)
+                samples_file.write(json.dumps(encoder.encode(sample_time, state), separators=(',', ':')) + '\n')
+                samples_file.flush()
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                # Keep sampling through server restarts and network errors, leaving a gap in the samples
+                print('%s %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e), file=sys.stderr)
+            # Sleep until the next multiple of the interval, so slow requests do not make samples drift, skipping
+            # any missed while sampling rather than catching up with samples in quick succession
+            slot = max(slot + 1, int(math.ceil((time.time() - start_time) / interval)))
+            time.sleep(max(0, start_time + slot * interval - time.time()))
+
+def decode_samples(file_path):
+    writer = csv.writer(sys.stdout)
+    for sample_time, state in read_samples(file_path):
+        writer.writerow([datetime.fromtimestamp(sample_time).strftime('%Y-%m-%d %H:%M:%S'),
+                         len(state['queued']), len(state['busy']), state['online'], state['enabled']])
+
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], '', ['interval=', 'duration=', 'output=', 'decode'])
+    opts = dict(optlist)
+    if len(args) > 1:
+        print(USAGE)
+        exit(1)
+
+    try:
+        if '--decode' in opts:
+            decode_samples(args[0] if args else opts.get('--output', DEFAULT_SAMPLES_FILE))
+        else:
+            sample_queue(opts.get('--output', DEFAULT_SAMPLES_FILE), float(opts.get('--interval', DEFAULT_INTERVAL_SECONDS)),
+                         float(opts['--duration']) if '--duration' in opts else None)
+    except KeyboardInterrupt:
+        print('KeyboardInterrupt')
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+import csv
+import getopt
+import sys
+
+from datetime import datetime
+
+from lib.bamboo import configure_yaml_loader, parse_yml
+from lib.capacity import simulate
+from lib.planstore import DirectoryPlanSource, PlanStore
+from lib.results import parse_completed_date, read_results, sheets_time_to_seconds
+from lib.travis import stage_job_counts
+
+EPOCH = datetime(1970, 1, 1)
+DEFAULT_CONCURRENCY = '5,10,20,50'
+
+USAGE = '''Usage: simulate-capacity.py [--concurrency=N[,N...]] [--plans=DIR | --store=FILE] [--shard-tests=N]
+                            [--since=YYYY-MM-DD] [--until=YYYY-MM-DD] RESULTS_CSV...
+
+Replays the build history dumped by results.py against each given limit on the number of Travis
+jobs running at once, writing one CSV row of predicted queue waits, utilisation and peak backlog per
+limit. Plans given using --plans or --store are used to split builds into the stages and parallel
+jobs they are converted into; builds of other plans are simulated as a single job.
+'''
+
+
+def load_stage_jobs(plan_source, context):
+    configure_yaml_loader()
+    plan_stage_jobs = {}
+    for key in plan_source.keys():
+        with plan_source.open(key) as plan_file:
+            plan = parse_yml(plan_file)
+        if plan is not None:
+            plan_stage_jobs[plan.full_key()] = stage_job_counts(plan, context)
+    return plan_stage_jobs
+
+def parse_date(completed_date):
+    try:
+        # Much faster than strptime, which matters when replaying a long build history
+        return datetime.fromisoformat(completed_date)
+    except ValueError:
+        return parse_completed_date(completed_date)
+
+def load_builds(file_paths, plan_stage_jobs, since=None, until=None):
+    builds = []
+    for file_path in file_paths:
+        for result_row in read_results(file_path):
+            duration = sheets_time_to_seconds(result_row['duration'])
+            if duration <= 0:
+                continue
+            completed_date = parse_date(result_row['completed_date'])
+            if (since is not None and completed_date < since) or (until is not None and completed_date >= until):
+                continue
+            start_time = (completed_date - EPOCH).total_seconds() - duration
+            builds.append((start_time, duration, plan_stage_jobs.get(result_row['plan_key'], [1])))
+    return builds
+
+
+if __name__ == '__main__':
+    optlist, args = getopt.getopt(sys.argv[1:], '', ['concurrency=', 'plans=', 'store=', 'shard-tests=', 'since=', 'until='])
+    opts = dict(optlist)
+    if len(args) == 0:
+        print(USAGE)
+        exit(1)
+
+    if '--store' in opts:
+        plan_stage_jobs = load_stage_jobs(PlanStore(opts['--store']), {'test_shards': int(opts.get('--shard-tests', 1))})
+    elif '--plans' in opts:
+        plan_stage_jobs = load_stage_jobs(DirectoryPlanSource(opts['--plans']), {'test_shards': int(opts.get('--shard-tests', 1))})
+    else:
+        plan_stage_jobs = {}
+    since = datetime.strptime(opts['--since'], '%Y-%m-%d') if '--since' in opts else None
+    until = datetime.strptime(opts['--until'], '%Y-%m-%d') if '--until' in opts else None
+    builds = load_builds(args, plan_stage_jobs, since, until)
+
+    writer = None
+    for concurrency in opts.get('--concurrency', DEFAULT_CONCURRENCY).split(','):
+        statistics = simulate(builds, int(concurrency))
+        if writer is None:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(statistics.keys()))
+            writer.writeheader()
+        writer.writerow({key: '%.3f' % (value) if isinstance(value, float) else value for key, value in statistics.items()})
+        sys.stdout.flush()